@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+from time import perf_counter
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional
+
+# Make the msm package importable when this file is run directly
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.world_generator import generate_server, generate_backup_history  # noqa: E402
+
+BACKUP_DIRECTORIES = ["worlds", "behavior_packs", "resource_packs"]
+
+
+def peak_rss_mb() -> float:
+    """Peak memory of this process, ru_maxrss is in kilobytes on Linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def folder_stats(path: Path) -> tuple[int, int]:
+    files = 0
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return files, size
+
+
+def bench_archive(server: Path, work: Path, format: str, workers: int) -> dict[str, Any]:
+    from msm.core.archive import write_archive
+
+    directories = [server / name for name in BACKUP_DIRECTORIES]
+    files, size = folder_stats(server)
+
+    t_beginning = perf_counter()
+    archive = write_archive(directories, work / "backup", workers=workers, format=format)
+    seconds = perf_counter() - t_beginning
+
+    return {"seconds": seconds, "files": files, "bytes": size, "output_bytes": archive.stat().st_size}
+
+
+def bench_quick_backup(server: Path, work: Path, format: str, workers: int) -> dict[str, Any]:
+    """The whole quick backup, written to a local and a hdd folder"""
+    from msm.config.load_config import Config
+    from msm.core.backup import quick_backup
+
+    cfg = Config(
+        mc_ip="127.0.0.1", mc_port=19132,  # type: ignore
+        path_base=str(work),
+        backup_local_path=str(work / "local"),
+        backup_hdd_path=str(work / "hdd"),
+        backup_directories=[str(server / name) for name in BACKUP_DIRECTORIES],
+        backup_format=format,
+        backup_workers=workers,
+        # The benchmark measures writing, a backup skipped for lack of space would report a bogus speed
+        backup_space={"local": 0, "hdd": 0},
+    )
+    files, size = folder_stats(server)
+
+    t_beginning = perf_counter()
+    quick_backup(cfg)
+    seconds = perf_counter() - t_beginning
+
+    # Both destinations are written, so twice the data is moved
+    return {"seconds": seconds, "files": files, "bytes": size * 2}
+
+
+def bench_retention(work: Path, backups: int) -> dict[str, Any]:
+    """Clear a history of sparse backups until half of it is freed"""
+    from msm.core.clear_backup import clear_backups
+    from msm.core import catalog
+
+    location = work / "history"
+    backup_size = 1024 ** 3
+    total = generate_backup_history(location, backups, backup_size)
+
+    t_beginning = perf_counter()
+    clear_backups(location, total / 2 / (1024 ** 3))
+    seconds = perf_counter() - t_beginning
+
+    # Only the archives count, the catalog and its journal files are in the location too
+    catalog.reconcile(location)
+    remaining = len(catalog.list_backups(location))
+    return {"seconds": seconds, "files": backups, "removed": backups - remaining, "bytes": 0}
+
+
+def run_case(case: dict[str, Any]) -> dict[str, Any]:
+    """Run one benchmark in its own process, so the peak memory belongs to this case only"""
+    with tempfile.TemporaryDirectory(prefix="bsm_bench_", dir=case.get("tmp")) as work_dir:
+        work = Path(work_dir)
+        server = Path(case["server"]) if case.get("server") else None
+
+        if case["kind"] == "archive":
+            result = bench_archive(server, work, case["format"], case["workers"])  # type: ignore
+        elif case["kind"] == "quick_backup":
+            result = bench_quick_backup(server, work, case["format"], case["workers"])  # type: ignore
+        else:
+            result = bench_retention(work, case["backups"])
+
+    result["mb_per_s"] = result["bytes"] / (1024 ** 2) / result["seconds"] if result["seconds"] > 0 else 0
+    result["peak_rss_mb"] = peak_rss_mb()
+    return {**case, **result}
+
+
+def git_version() -> Optional[str]:
+    try:
+        output = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, cwd=Path(__file__).parent)
+        return output.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results: list[dict[str, Any]], previous_path: Path):
+    """Print how much faster or slower every case is than in an earlier result file"""
+    previous = {result["name"]: result for result in json.loads(previous_path.read_text())["results"]}
+
+    print(f"\nCompared to {previous_path}:")
+    for result in results:
+        old = previous.get(result["name"])
+        if not old:
+            continue
+        change = (old["seconds"] - result["seconds"]) / old["seconds"] * 100 if old["seconds"] else 0
+        print(f"{result['name']:<40} {old['seconds']:8.2f}s -> {result['seconds']:8.2f}s ({abs(change):.1f}% {'faster' if change >= 0 else 'slower'})")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the backup pipeline on a synthetic Bedrock server")
+    parser.add_argument("--size-mb", type=int, default=256, help="total size of the generated worlds")
+    parser.add_argument("--files", type=int, default=1000, help="amount of files in the generated worlds")
+    parser.add_argument("--worlds", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--formats", default="zip,zip-stored,tar.zst")
+    parser.add_argument("--workers", default=f"1,{os.cpu_count() or 1}", help="comma separated amounts of workers")
+    parser.add_argument("--backups", default="100,1000", help="comma separated history sizes for the retention benchmark")
+    parser.add_argument("--tmp", help="folder for generated files, use one on the disk you want to measure")
+    parser.add_argument("--output", type=Path, default=Path(f"bench_{datetime.now():%Y-%m-%d_%H-%M-%S}.json"))
+    parser.add_argument("--compare", type=Path, help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    formats = args.formats.split(",")
+    workers = sorted({int(amount) for amount in args.workers.split(",")})
+    history_sizes = [int(amount) for amount in args.backups.split(",") if amount]
+
+    with tempfile.TemporaryDirectory(prefix="bsm_world_", dir=args.tmp) as server_dir:
+        print(f"Generating a {args.size_mb} MB world with {args.files} files...")
+        world = generate_server(Path(server_dir), args.size_mb, args.files, args.worlds, seed=args.seed)
+
+        cases: list[dict[str, Any]] = []
+        for format in formats:
+            for amount in workers:
+                cases.append({"name": f"archive {format} x{amount}", "kind": "archive", "format": format, "workers": amount})
+        cases.append({"name": f"quick_backup zip x{workers[-1]}", "kind": "quick_backup", "format": "zip", "workers": workers[-1]})
+        for backups in history_sizes:
+            cases.append({"name": f"retention {backups} backups", "kind": "retention", "backups": backups})
+
+        # Every case gets a fresh process, spawned so it doesn't inherit the memory of the generator
+        context = multiprocessing.get_context("spawn")
+        results: list[dict[str, Any]] = []
+        for case in cases:
+            case.update(server=server_dir, tmp=args.tmp)
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case, (case,))
+            results.append(result)
+            print(f"{result['name']:<40} {result['seconds']:8.2f}s {result['mb_per_s']:8.1f} MB/s {result['peak_rss_mb']:8.1f} MB RSS {result['files']:>7} files")
+
+    report = {
+        "version": git_version(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "world": world,
+        "results": [{key: value for key, value in result.items() if key not in ("server", "tmp")} for result in results],
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        compare(report["results"], args.compare)
+
+
+if __name__ == "__main__":
+    main()
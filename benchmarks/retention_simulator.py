@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import random
+import tempfile
+import multiprocessing
+from collections import Counter, namedtuple
+from time import perf_counter
+from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Optional
+from unittest import mock
+
+# Make the msm package importable when this file is run directly
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.world_generator import write_backup_history  # noqa: E402
+
+GB = 1024 ** 3
+
+# Age of a backup for the survivor report, the last bucket is everything older
+AGE_BUCKETS = [("1 day", timedelta(days=1)), ("1 week", timedelta(weeks=1)), ("1 month", timedelta(days=31)), ("1 year", timedelta(days=365))]
+
+# Audit events of the file system calls the cleanup makes, stat calls have no audit event
+AUDIT_EVENTS = {"open", "os.scandir", "os.listdir", "os.remove", "os.rmdir", "os.mkdir", "os.rename", "sqlite3.connect"}
+
+# Same fields as the result of psutil.disk_usage
+DiskUsage = namedtuple("DiskUsage", "total used free percent")
+
+
+@dataclass(frozen=True)
+class History:
+    """A synthetic backup history that ends now, with the backups spread evenly over the years"""
+    backups: int
+    years: float = 3
+    size_gb: float = 1.0
+    spread: float = 0.2
+    growth: float = 0.5
+    full_every: int = 0
+    incremental_size: float = 0.05
+    seed: int = 0
+
+
+def generate_history(history: History, now: datetime) -> list[tuple[datetime, int, bool]]:
+    """
+    Backups as (date, size, incremental), oldest first. The size of a full backup is normally distributed around
+    size_gb with the relative spread, and the world grows with 'growth' per year, so older backups are smaller.
+    With full_every there are that many incremental backups after every full one.
+    """
+    rng = random.Random(history.seed)
+    interval = timedelta(days=365 * history.years) / max(1, history.backups)
+    result: list[tuple[datetime, int, bool]] = []
+
+    for index in range(history.backups):
+        age = interval * (history.backups - 1 - index)
+        # Backups don't start at exactly the same time every day
+        date = (now - age - interval * rng.uniform(0, 0.25)).replace(microsecond=0)
+        incremental = history.full_every > 0 and index % (history.full_every + 1) != 0
+
+        size = history.size_gb * GB / (1 + history.growth) ** (age.days / 365)
+        size *= history.incremental_size if incremental else 1
+        size *= max(0.1, rng.gauss(1, history.spread))
+        # Sparse files with the same size have the same content, so every size is unique to not make them duplicates
+        result.append((date, int(size) + index, incremental))
+
+    return result
+
+
+def survivors(dates: list[datetime], now: datetime) -> dict[str, int]:
+    """Amount of remaining backups per age"""
+    report: dict[str, int] = Counter()
+    for date in dates:
+        bucket = next((name for name, age in AGE_BUCKETS if now - date <= age), "older")
+        report[f"<= {bucket}" if bucket != "older" else bucket] += 1
+    return {f"<= {name}": report.get(f"<= {name}", 0) for name, _ in AGE_BUCKETS} | {"older": report.get("older", 0)}
+
+
+class SyscallCounter:
+    """Counts file system calls through audit hooks and the read and write syscalls of the process"""
+
+    def __init__(self):
+        self.events: Counter[str] = Counter()
+        self.active = False
+        sys.addaudithook(self.hook)
+
+    def hook(self, event: str, _):
+        if self.active and event in AUDIT_EVENTS:
+            self.events[event] += 1
+
+    @staticmethod
+    def process_io() -> dict[str, int]:
+        """Read and write syscalls so far, only on Linux"""
+        try:
+            lines = Path("/proc/self/io").read_text().splitlines()
+        except OSError:
+            return {}
+        values = dict(line.split(": ") for line in lines)
+        return {"read": int(values["syscr"]), "write": int(values["syscw"])}
+
+    def __enter__(self) -> "SyscallCounter":
+        self.events.clear()
+        self.io_beginning = self.process_io()
+        self.active = True
+        return self
+
+    def __exit__(self, *_):
+        self.active = False
+        io_end = self.process_io()
+        self.io = {name: io_end[name] - self.io_beginning[name] for name in io_end}
+
+    def report(self) -> dict[str, int]:
+        return dict(sorted(self.events.items())) | self.io
+
+
+class SimulatedDisk:
+    """A disk of a fixed size that only holds the backup location, the sparse files count with their full size"""
+
+    def __init__(self, location: Path, capacity: int):
+        self.location = location
+        self.capacity = capacity
+
+    def disk_usage(self, _: str) -> DiskUsage:
+        used = sum(entry.stat().st_size for folder in os.scandir(self.location) if folder.is_dir() for entry in os.scandir(folder.path) if entry.is_file())
+        return DiskUsage(self.capacity, used, self.capacity - used, used / self.capacity * 100)
+
+
+def simulate_on_disk(history: History, retention: dict[str, int], free_fraction: Optional[float], disk_gb: Optional[float], min_free_gb: float, tmp: Optional[str]) -> dict[str, Any]:
+    """Write the history as sparse files and run the cleanup on it like a backup location would"""
+    from msm.core import catalog, clear_backup
+    from msm.core.retention import RetentionPolicy
+
+    now = datetime.now()
+    counter = SyscallCounter()
+    policy = RetentionPolicy.parse(retention)
+
+    with tempfile.TemporaryDirectory(prefix="bsm_retention_", dir=tmp) as work_dir:
+        location = Path(work_dir)
+        t_beginning = perf_counter()
+        total = write_backup_history(location, generate_history(history, now))
+        generate_seconds = perf_counter() - t_beginning
+
+        with counter:
+            t_beginning = perf_counter()
+            if disk_gb is not None:
+                # check_and_clear reads the free space of the simulated disk instead of the real one
+                disk = SimulatedDisk(location, int(disk_gb * GB))
+                with mock.patch.object(clear_backup.psutil, "disk_usage", disk.disk_usage):
+                    clear_backup.check_and_clear(location, min_free_gb, "Simulated disk", policy=policy)
+            else:
+                clear_backup.clear_backups(location, total / GB * (free_fraction or 0.5), policy=policy)
+            seconds = perf_counter() - t_beginning
+
+        # check_and_clear may not have touched the catalog if there was enough space
+        catalog.reconcile(location)
+        remaining = catalog.list_backups(location)
+
+    left = sum(backup.size for backup in remaining)
+    return {
+        "seconds": seconds,
+        "generate_seconds": generate_seconds,
+        "backups": history.backups,
+        "removed": history.backups - len(remaining),
+        "gb_before": total / GB,
+        "gb_freed": (total - left) / GB,
+        "survivors": survivors([backup.timestamp for backup in remaining], now),
+        "syscalls": counter.report(),
+    }
+
+
+def simulate_in_memory(history: History, retention: dict[str, int], free_fraction: Optional[float]) -> dict[str, Any]:
+    """Only plan the cleanup, without any files, so the planning itself can be measured for huge histories"""
+    from msm.core.retention import Backup, RetentionPolicy, plan_retention
+
+    now = datetime.now()
+    backups = [Backup(Path(date.strftime("%Y-%m-%d/backup_%H-%M-%S.zip")), date, size, incremental) for date, size, incremental in generate_history(history, now)]
+    total = sum(backup.size for backup in backups)
+
+    t_beginning = perf_counter()
+    plan, freed = plan_retention(backups, RetentionPolicy.parse(retention), int(total * (free_fraction or 0.5)))
+    seconds = perf_counter() - t_beginning
+
+    removed = {backup.path for backup in plan}
+    return {
+        "seconds": seconds,
+        "backups": history.backups,
+        "removed": len(removed),
+        "gb_before": total / GB,
+        "gb_freed": freed / GB,
+        "survivors": survivors([backup.date for backup in backups if backup.path not in removed], now),
+    }
+
+
+def run_case(case: dict[str, Any]) -> dict[str, Any]:
+    """Run one simulation in its own process, so the audit hook and peak memory belong to this case only"""
+    import logging
+    import resource
+
+    # The cleanup logs every removed backup
+    logging.getLogger("bsm").setLevel(logging.WARNING)
+
+    history = History(**case["history"])
+    if case["in_memory"]:
+        result = simulate_in_memory(history, case["retention"], case["free"])
+    else:
+        result = simulate_on_disk(history, case["retention"], case["free"], case["disk_gb"], case["min_free_gb"], case["tmp"])
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulate the backup cleanup on years of synthetic backup history")
+    parser.add_argument("--backups", default="100,1000,10000,100000", help="comma separated history sizes")
+    parser.add_argument("--years", type=float, default=3, help="the history is spread over this many years")
+    parser.add_argument("--size-gb", type=float, default=1.0, help="average size of a full backup now")
+    parser.add_argument("--spread", type=float, default=0.2, help="relative standard deviation of the backup size")
+    parser.add_argument("--growth", type=float, default=0.5, help="growth of the world per year, eg. 0.5 for 50%%")
+    parser.add_argument("--full-every", type=int, default=0, help="incremental backups after every full one")
+    parser.add_argument("--incremental-size", type=float, default=0.05, help="size of an incremental backup relative to a full one")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--retention", type=json.loads, default={}, help="retention policy as JSON, eg. '{\"daily\": 14}'")
+    parser.add_argument("--free", type=float, help="part of the history to free with clear_backups, 0.5 by default")
+    parser.add_argument("--disk-gb", type=float, help="run check_and_clear on a simulated disk of this size instead")
+    parser.add_argument("--min-free-gb", type=float, default=30, help="free space check_and_clear keeps on the simulated disk")
+    parser.add_argument("--in-memory", action="store_true", help="only plan the cleanup, no files are written")
+    parser.add_argument("--tmp", help="folder for the sparse files")
+    parser.add_argument("--output", type=Path, help="save the results as JSON")
+    args = parser.parse_args()
+
+    results: list[dict[str, Any]] = []
+    context = multiprocessing.get_context("spawn")
+    for backups in [int(amount) for amount in args.backups.split(",") if amount]:
+        history = History(backups, args.years, args.size_gb, args.spread, args.growth, args.full_every, args.incremental_size, args.seed)
+        case = {
+            "history": asdict(history), "retention": args.retention, "free": args.free, "disk_gb": args.disk_gb,
+            "min_free_gb": args.min_free_gb, "in_memory": args.in_memory, "tmp": args.tmp,
+        }
+        with context.Pool(1) as pool:
+            result = pool.apply(run_case, (case,))
+        results.append(result)
+
+        print(f"{backups:>7} backups {result['seconds']:8.3f}s {result['removed']:>7} removed {result['gb_freed']:10.1f} of {result['gb_before']:.1f} GB freed {result['peak_rss_mb']:8.1f} MB RSS")
+        print(f"        survivors: {', '.join(f'{age} {amount}' for age, amount in result['survivors'].items())}")
+        if "syscalls" in result:
+            print(f"        syscalls: {', '.join(f'{name} {amount}' for name, amount in result['syscalls'].items())}")
+
+    if args.output:
+        args.output.write_text(json.dumps({"date": datetime.now().isoformat(timespec="seconds"), "arguments": vars(args) | {"output": str(args.output)}, "results": results}, indent=2))
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
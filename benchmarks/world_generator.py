@@ -0,0 +1,143 @@
+import os
+import random
+from pathlib import Path
+from datetime import datetime, timedelta
+from typing import Any, Iterable
+
+# Sizes of the files the Bedrock server writes itself
+LDB_SIZE = 2 * 1024 * 1024
+LOG_SIZE = 4 * 1024 * 1024
+PACK_FILE_SIZE = 64 * 1024
+
+
+def random_data(rng: random.Random, size: int, compressibility: float) -> bytes:
+    """
+    Data that compresses to about (1 - compressibility) of its size.
+    LevelDB tables are already compressed, so they use a low compressibility.
+    """
+    repeated = int(size * compressibility)
+    return rng.randbytes(size - repeated) + bytes(repeated)
+
+
+def write_file(path: Path, data: bytes) -> int:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return len(data)
+
+
+def generate_world(world_path: Path, rng: random.Random, size: int, files: int) -> tuple[int, int]:
+    """Generate a single world with the layout of a Bedrock world, returns the amount of files and bytes"""
+    db = world_path / "db"
+    written = 0
+    amount = 0
+
+    # Small files every world has
+    written += write_file(world_path / "levelname.txt", world_path.name.encode())
+    written += write_file(world_path / "level.dat", rng.randbytes(2560))
+    written += write_file(world_path / "level.dat_old", rng.randbytes(2560))
+    written += write_file(world_path / "world_icon.jpeg", rng.randbytes(40 * 1024))
+    written += write_file(db / "CURRENT", b"MANIFEST-000042\n")
+    written += write_file(db / "LOCK", b"")
+    written += write_file(db / "MANIFEST-000042", random_data(rng, 64 * 1024, 0.5))
+    amount += 7
+
+    # The write ahead log, compresses well since it has a lot of repeated keys
+    log_size = min(LOG_SIZE, max(0, size - written) // 10)
+    written += write_file(db / "000043.log", random_data(rng, log_size, 0.6))
+    amount += 1
+
+    # Fill the rest with tables, until the size or amount of files is reached
+    number = 44
+    while written < size and amount < files:
+        table_size = min(LDB_SIZE, size - written)
+        written += write_file(db / f"{number:06d}.ldb", random_data(rng, table_size, 0.1))
+        number += 1
+        amount += 1
+
+    return amount, written
+
+
+def generate_packs(packs_path: Path, rng: random.Random, kind: str, packs: int) -> tuple[int, int]:
+    """Generate behavior or resource packs, resource packs mostly contain images and sounds"""
+    written = 0
+    amount = 0
+
+    for index in range(packs):
+        pack = packs_path / f"{kind}_{index}"
+        written += write_file(pack / "manifest.json", f'{{"format_version": 2, "header": {{"name": "{kind} {index}"}}}}'.encode())
+        amount += 1
+
+        if kind == "resource_pack":
+            for number in range(10):
+                written += write_file(pack / "textures" / f"block_{number}.png", rng.randbytes(PACK_FILE_SIZE))
+                written += write_file(pack / "sounds" / f"sound_{number}.ogg", rng.randbytes(PACK_FILE_SIZE))
+                amount += 2
+        else:
+            for number in range(10):
+                written += write_file(pack / "scripts" / f"script_{number}.js", random_data(rng, PACK_FILE_SIZE // 4, 0.7))
+                amount += 1
+
+    return amount, written
+
+
+def generate_server(root: Path, size_mb: int = 256, files: int = 1000, worlds: int = 1, packs: int = 2, seed: int = 0) -> dict[str, Any]:
+    """
+    Generate a synthetic Bedrock server folder with worlds, behavior and resource packs.
+    The same seed always generates the same files.
+    """
+    rng = random.Random(seed)
+    world_size = size_mb * 1024 * 1024 // worlds
+    world_files = max(8, files // worlds)
+
+    amount = 0
+    written = 0
+    for index in range(worlds):
+        world_amount, world_written = generate_world(root / "worlds" / f"Bedrock level {index}", rng, world_size, world_files)
+        amount += world_amount
+        written += world_written
+
+    for kind, folder in [("behavior_pack", "behavior_packs"), ("resource_pack", "resource_packs")]:
+        pack_amount, pack_written = generate_packs(root / folder, rng, kind, packs)
+        amount += pack_amount
+        written += pack_written
+
+    return {"files": amount, "bytes": written, "worlds": worlds, "packs": packs, "seed": seed}
+
+
+def write_backup_history(location: Path, history: Iterable[tuple[datetime, int, bool]]) -> int:
+    """
+    Write backups as (date, size, incremental) in the layout quick_backup writes, eg. '2025-03-24/backup_20-00-00.zip'.
+    Files are sparse, so thousands of backups barely use any disk space. Returns the total size in bytes.
+    """
+    total = 0
+    for date, size, incremental in history:
+        path = location / date.strftime("%Y-%m-%d") / date.strftime(f"backup_%H-%M-%S{'_incr' if incremental else ''}.zip")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            f.truncate(size)
+        total += size
+    return total
+
+
+def generate_backup_history(location: Path, backups: int, backup_size: int, per_day: int = 3) -> int:
+    """Generate a folder of old full backups, a few per day. Returns the total size in bytes"""
+    now = datetime.now()
+    # Every backup gets another size, otherwise they would all be seen as duplicates
+    history = [(now - timedelta(days=index // per_day, hours=index % per_day), backup_size + index, False) for index in range(backups)]
+    return write_backup_history(location, history)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic Bedrock server folder")
+    parser.add_argument("location", type=Path)
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--worlds", type=int, default=1)
+    parser.add_argument("--packs", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.location, exist_ok=True)
+    print(generate_server(args.location, args.size_mb, args.files, args.worlds, args.packs, args.seed))
@@ -3,11 +3,18 @@ from msm.services.server_status import check_playercount
 from msm.services.check_ha import entity_status
 from msm.config.load_config import Config
 import msm.core.backup as backup
+from msm.core.precopy import precopy, remove_staging
+from msm.core.restore import restore_backup
+from msm.core.throttle import throttled, set_server_state
 from msm.core.minecraft_updater import get_console_bridge, update_minecraft_server
 import sys
+import argparse
 from datetime import datetime
+from time import monotonic
+from typing import Callable, Optional
 from enum import Enum
 import subprocess
+import threading
 import os
 from pathlib import Path
 import logging
@@ -33,6 +40,7 @@ class Mode(Enum):
     DRIVE_BACKUP = "drive backup"  
     INVALID = "invalid time"  
     CONFIGURATION = "config"
+    RESTORE = "restore"
 
 
 def shutdown(reboot: bool = False):
@@ -59,6 +67,10 @@ def get_mode():
     except FileNotFoundError:
         return Mode.CONFIGURATION
 
+    # Restoring is started by hand, so it is allowed at any time
+    if len(sys.argv) > 1 and sys.argv[1] == "restore":
+        return Mode.RESTORE
+
     time = datetime.now()
     hour = time.hour
     log.info(f"Current hour: {hour}")
@@ -82,6 +94,84 @@ def stop_server(cfg: Config):
     mc_updater_path = os.path.join(cfg.path_base, "minecraft_updater")
     subprocess.run(['bash', mc_updater_path+'/updater/stopserver.sh', mc_updater_path])
 
+    # Backups get full speed once the server is stopped
+    set_server_state("stopped")
+
+
+def hot_backup_scheduler(cfg: Config) -> tuple[Callable[[int], None], Callable[[], None]]:
+    """
+    Make a hot backup every 'hot_interval' minutes while players are online, on its own thread so the player checks
+    keep running and the throttle follows the server. Returns the check and a function that waits for a running backup.
+    """
+    last_backup = monotonic()
+    thread: Optional[threading.Thread] = None
+
+    def run():
+        nonlocal last_backup
+        try:
+            # Throttled, so players don't notice the backup
+            with throttled(cfg):
+                backup.main(cfg, type="hot")
+        except Exception as e:
+            log.error(f"Hot backup failed: {e}")
+        last_backup = monotonic()
+
+    def check(online_players: int):
+        nonlocal thread
+        # A backup that is still running is not started again
+        if thread and thread.is_alive():
+            return
+        if cfg.backup_hot_interval and online_players > 0 and monotonic() - last_backup >= cfg.backup_hot_interval * 60:
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+
+    def finish():
+        if thread:
+            thread.join()
+
+    return check, finish
+
+
+def precopy_scheduler(cfg: Config) -> tuple[Callable[[int], None], Callable[[], bool]]:
+    """
+    Start staging the backup once the server was used and no one has been online for the 'precopy' part of the shutdown time.
+    Returns the check and a function that waits for the pre-copy, it tells if the staged copy can be used.
+    """
+    checks_needed = max(1, int(cfg.timing_shutdown * 60 / 10 * (cfg.backup_precopy or 1)))  # type: ignore
+    times_no_one = 0
+    server_used = False
+    thread: Optional[threading.Thread] = None
+    failed = False
+
+    def run():
+        nonlocal failed
+        try:
+            with throttled(cfg):
+                precopy(cfg)
+        except Exception as e:
+            log.error(f"Pre-copy failed: {e}")
+            remove_staging(cfg)
+            failed = True
+
+    def check(online_players: int):
+        nonlocal times_no_one, server_used, thread, failed
+        times_no_one = times_no_one + 1 if online_players == 0 else 0
+        server_used = server_used or online_players > 0
+
+        # Only one pre-copy at a time, a later one after players left again only copies the changes
+        if server_used and times_no_one == checks_needed and not (thread and thread.is_alive()):
+            failed = False
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+
+    def finish() -> bool:
+        if thread is None:
+            return False
+        thread.join()
+        return not failed
+
+    return check, finish
+
 
 def normal_operation():
     update_DNS(cfg)
@@ -103,16 +193,42 @@ def normal_operation():
             subprocess.Popen(["java", "-jar", str(console_bridge)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=console_bridge_dir)
 
     if cfg.timing_shutdown:
+        checks: list[Callable[[int], None]] = []
+        hot_backup_finished: Optional[Callable[[], None]] = None
+        if cfg.backup_hot_interval and cfg.backup_directories:
+            hot_backup_check, hot_backup_finished = hot_backup_scheduler(cfg)
+            checks.append(hot_backup_check)
+
+        precopy_finished: Optional[Callable[[], bool]] = None
+        if cfg.backup_precopy and cfg.backup_directories:
+            precopy_check, precopy_finished = precopy_scheduler(cfg)
+            checks.append(precopy_check)
+
+        def on_check(online_players: int):
+            # Throttled jobs follow the state of the server
+            set_server_state("online" if online_players > 0 else "empty")
+            for check in checks:
+                check(online_players)
+
         while True:
-            server_used = check_playercount(cfg)
+            server_used = check_playercount(cfg, on_check)
             auto_shutdown_enabled = entity_status(cfg)
 
             if server_used:
                 if auto_shutdown_enabled:
+                    # A hot backup holds the saves of the running server, it has to finish first
+                    if hot_backup_finished:
+                        hot_backup_finished()
                     stop_server(cfg)
 
                     if cfg.backup_directories:
-                        backup.main(cfg, type="quick")
+                        # With a pre-copy only the files changed since then are copied after the stop
+                        precopied = precopy_finished is not None and precopy_finished()
+                        try:
+                            backup.main(cfg, type="precopied" if precopied else "quick")
+                        except Exception as e:
+                            # A failed backup must not keep the machine running
+                            log.error(f"Backup failed: {e}")
                     else:
                         log.info("No backup directories, skipping backup")
                     
@@ -123,6 +239,8 @@ def normal_operation():
                 if auto_shutdown_enabled:
                     log.info("No one online, but server was not used, backup is not needed")
                     log.info("Shutting down Minecraft server...")
+                    if hot_backup_finished:
+                        hot_backup_finished()
                     stop_server(cfg)
                     log.info("Shutting down...")
                     shutdown()
@@ -130,9 +248,28 @@ def normal_operation():
         log.warning("Auto shutdown is off, this is not reccomended, backups will not work")
 
 
+def restore():
+    parser = argparse.ArgumentParser(prog="main.py restore", description="Restore a backup, the server is stopped while restoring")
+    parser.add_argument("backup", nargs="?", help="path or name of the backup, or a snapshot id, the latest backup by default")
+    parser.add_argument("--world", help="only restore this world")
+    args = parser.parse_args(sys.argv[2:])
+
+    stop_server(cfg)
+    try:
+        restore_backup(cfg, args.backup, args.world)
+    finally:
+        # A failed restore leaves the current files in place, so the server can always be started again
+        log.info("Starting Minecraft server...")
+        start_server(cfg)
+
+
 def drive_backup():
     log.info("Only backing up to drive")
-    backup.main(cfg, type="drive")
+    try:
+        backup.main(cfg, type="drive")
+    except Exception as e:
+        # Missing backups are uploaded with the next drive backup, so the machine still shuts down
+        log.error(f"Drive backup failed: {e}")
     log.info("Shutting down...")
     shutdown()
 
@@ -150,6 +287,9 @@ def main():
     elif mode == Mode.DRIVE_BACKUP:
         # Upload latest backup to drive, then shutdown
         drive_backup()
+    elif mode == Mode.RESTORE:
+        # Stop the server, restore the chosen backup and start it again
+        restore()
     elif mode == Mode.INVALID:
         # Shutdown server if started at incorrect time
         log.warning("Invalid time, shutting down")
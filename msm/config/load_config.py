@@ -1,11 +1,67 @@
 import yaml
 from pathlib import Path
 from dataclasses import dataclass
-from typing import Optional, List
+from fnmatch import fnmatch
+from typing import Any, Optional, List
 import os
 from ipaddress import IPv4Address, IPv6Address
 import sys
 
+COMPRESSION_MODES = ("auto", "deflate", "store")
+FREQUENCIES = ("shutdown", "daily", "weekly")
+
+
+@dataclass(frozen=True)
+class BackupDirectory:
+    """
+    A directory to back up. In the config it is either just a path or a mapping like:
+    {path: ..., include: ["worlds/**"], exclude: ["logs/**", "*.log"], compression: store, frequency: weekly}
+    Patterns are matched against the path relative to the directory, or just the file name.
+    """
+    path: str
+    include: tuple[str, ...] = ()
+    exclude: tuple[str, ...] = ()
+    compression: str = "auto"
+    frequency: str = "shutdown"
+
+    @classmethod
+    def parse(cls, entry: Any) -> "BackupDirectory":
+        if isinstance(entry, BackupDirectory):
+            return entry
+        if not isinstance(entry, dict):
+            return cls(path=str(entry))
+
+        directory = cls(
+            path=str(entry["path"]),
+            include=tuple(entry.get("include") or ()),  # type: ignore
+            exclude=tuple(entry.get("exclude") or ()),  # type: ignore
+            compression=entry.get("compression", "auto"),  # type: ignore
+            frequency=entry.get("frequency", "shutdown"),  # type: ignore
+        )
+        if directory.compression not in COMPRESSION_MODES:
+            raise ValueError(f"Unknown compression '{directory.compression}' for {directory.path}, use one of: {', '.join(COMPRESSION_MODES)}")
+        if directory.frequency not in FREQUENCIES:
+            raise ValueError(f"Unknown frequency '{directory.frequency}' for {directory.path}, use one of: {', '.join(FREQUENCIES)}")
+        return directory
+
+    @property
+    def name(self) -> str:
+        """Name of the top level folder inside the backups"""
+        return Path(self.path).name
+
+    def excluded(self, relative_path: str) -> bool:
+        return any(_matches(relative_path, pattern) for pattern in self.exclude)
+
+    def included(self, relative_path: str) -> bool:
+        return not self.include or any(_matches(relative_path, pattern) for pattern in self.include)
+
+
+def _matches(relative_path: str, pattern: str) -> bool:
+    # "logs/**" also matches the logs folder itself, so it can be skipped as a whole
+    if fnmatch(relative_path, pattern) or fnmatch(relative_path, pattern.removesuffix("/**")):
+        return True
+    return "/" not in pattern and fnmatch(relative_path.rsplit("/", 1)[-1], pattern)
+
 
 @dataclass(frozen=True)
 class Config:
@@ -20,6 +76,10 @@ class Config:
     
     ## Optional
 
+    # Minecraft Server console
+    mc_session: Optional[str] = None
+    mc_worlds: Optional[str] = None
+
     # Home Assistant
     ha_ip: Optional[str] = None
     ha_token: Optional[str] = None
@@ -34,7 +94,20 @@ class Config:
     backup_local_path: Optional[str] = None
     backup_hdd_path: Optional[str] = None
     backup_drive_name: Optional[str] = None
-    backup_directories: Optional[List[str]] = None
+    backup_directories: Optional[List[str | dict | BackupDirectory]] = None
+    backup_workers: Optional[int] = None
+    backup_format: Optional[str] = None
+    backup_level: Optional[int] = None
+    backup_incremental: Optional[bool] = None
+    backup_full_every: Optional[int] = None
+    backup_repository: Optional[bool] = None
+    backup_hot_interval: Optional[int] = None
+    backup_precopy: Optional[float] = None
+    backup_verify: Optional[bool] = None
+    backup_throttle: Optional[dict] = None
+    backup_retention: Optional[dict] = None
+    backup_space: Optional[dict] = None
+    backup_upload: Optional[dict] = None
 
     # Timing
     timing_begin_valid: Optional[int] = None
@@ -42,6 +115,9 @@ class Config:
     timing_shutdown: Optional[int] = None
     timing_drive_backup: Optional[int] = None
 
+    def get_backup_directories(self) -> list[BackupDirectory]:
+        return [BackupDirectory.parse(entry) for entry in self.backup_directories or []]
+
     @classmethod
     def load(cls) -> "Config":
         program_location = os.path.abspath(sys.executable if getattr(sys, 'frozen', False) else __file__)
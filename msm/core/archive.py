@@ -0,0 +1,442 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import zipfile
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import process_time
+from pathlib import Path
+from typing import IO, Any, Iterable, Iterator, Optional
+from msm.core.fanout import FanOutFile, Stream, partial_path
+from msm.core.throttle import ThrottledReader
+from msm.config.load_config import BackupDirectory
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+CHUNK_SIZE = 1024 * 1024
+# Compressed data bigger than this is spooled to disk instead of kept in memory
+SPOOL_SIZE = 16 * 1024 * 1024
+
+# Backup formats with the extension of their files
+FORMATS = {"zip": ".zip", "zip-stored": ".zip", "tar.zst": ".tar.zst"}
+DEFAULT_FORMAT = "zip"
+ZSTD_DEFAULT_LEVEL = 3
+# Compression levels every format accepts
+LEVELS = {"zip": range(0, 10), "zip-stored": range(0, 10), "tar.zst": range(1, 23)}
+
+# Files that are already compressed, deflating them again costs CPU time for almost no gain
+INCOMPRESSIBLE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".ogg", ".mp3", ".zip", ".mcpack", ".mcworld", ".mcaddon", ".gz", ".zst"}
+# Other files are probed by compressing a sample of their start
+SAMPLE_SIZE = 64 * 1024
+MIN_PROBE_SIZE = 16 * 1024
+STORE_RATIO = 0.9
+# Bytes per second deflate at level 1 roughly manages on one core, to estimate the time saved without a sample
+DEFLATE_SPEED = 100 * 1024 * 1024
+
+
+def walk_backup_directories(directories: Iterable[str | Path | BackupDirectory], skip: Iterable[str | Path] = ()) -> Iterator[tuple[Path, str]]:
+    """
+    Walk the backup directories and yield every folder and file with its name inside the archive.
+    Every directory keeps its own name as top level folder, eg. "worlds/db/000005.ldb"
+    Include and exclude rules are checked during the walk, so excluded folders are never read.
+    """
+    skipped = {os.path.realpath(path) for path in skip}
+
+    for entry in directories:
+        directory = BackupDirectory.parse(entry)
+        root = Path(directory.path)
+        top_level = directory.name
+
+        yield root, top_level
+
+        # Symlinks are followed, just like copytree did before
+        for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+            relative_dir = Path(dirpath).relative_to(root).as_posix()
+            relative_dir = "" if relative_dir == "." else relative_dir + "/"
+
+            # Skipped and excluded folders are pruned, so they are never walked
+            dirnames[:] = sorted(
+                name for name in dirnames
+                if os.path.realpath(os.path.join(dirpath, name)) not in skipped and not directory.excluded(relative_dir + name)
+            )
+
+            # With include rules only the included files matter, their folders are created on extraction anyway
+            if not directory.include:
+                for name in dirnames:
+                    yield Path(dirpath, name), f"{top_level}/{relative_dir}{name}"
+
+            for name in sorted(filenames):
+                path = Path(dirpath, name)
+                relative_path = relative_dir + name
+                # Never add the archive that is being written to itself
+                if os.path.realpath(path) in skipped or not path.is_file():
+                    continue
+                if directory.excluded(relative_path) or not directory.included(relative_path):
+                    continue
+                yield path, f"{top_level}/{relative_path}"
+
+
+def changed_size(directories: Iterable[str | Path | BackupDirectory], previous: dict[str, dict[str, Any]], skip: Iterable[str | Path] = ()) -> int:
+    """
+    Size of the files that are new or have another size or mtime than in a previous manifest or snapshot,
+    with an empty one the size of every file. Only the metadata is read.
+    """
+    size = 0
+    for path, arcname in walk_backup_directories(directories, skip=skip):
+        if path.is_dir():
+            continue
+        stat = path.stat()
+        old = previous.get(arcname)
+        if not old or old["size"] != stat.st_size or old["mtime"] != stat.st_mtime_ns:
+            size += stat.st_size
+    return size
+
+
+def compress_file(path: Path, level: int = zlib.Z_DEFAULT_COMPRESSION) -> tuple[int, int, int, IO[bytes]]:
+    """Deflate a single file, returns the crc, file size, compressed size and the compressed data"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    crc = 0
+    file_size = 0
+
+    with ThrottledReader(path) as f:
+        while chunk := f.read(CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            data.write(compressor.compress(chunk))
+    data.write(compressor.flush())
+
+    compress_size = data.tell()
+    data.seek(0)
+    return crc, file_size, compress_size, data  # type: ignore
+
+
+def write_file(zf: zipfile.ZipFile, path: Path, arcname: str, compress_type: Optional[int] = None):
+    """Same as ZipFile.write, but the file is read at the rate limit of throttled jobs"""
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    if zinfo.is_dir():
+        zf.write(path, arcname)
+        return
+
+    zinfo.compress_type = zf.compression if compress_type is None else compress_type
+    zinfo._compresslevel = zf.compresslevel  # type: ignore
+    with ThrottledReader(path) as src, zf.open(zinfo, "w") as dest:
+        shutil.copyfileobj(src, dest, CHUNK_SIZE)  # type: ignore
+
+
+def write_compressed_entry(zf: zipfile.ZipFile, path: Path, arcname: str, compressed: tuple[int, int, int, IO[bytes]]):
+    """Write an entry that was already deflated by compress_file into an open zip file"""
+    crc, file_size, compress_size, data = compressed
+
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = compress_size
+
+    # Same bookkeeping ZipFile does itself when an entry is written
+    fp = zf.fp
+    assert fp is not None
+    zinfo.header_offset = fp.tell()
+    zip64 = file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT
+    fp.write(zinfo.FileHeader(zip64))
+    with data:
+        shutil.copyfileobj(data, fp, CHUNK_SIZE)
+
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = fp.tell()
+
+
+def archive_name(backup_name: str, format: str = DEFAULT_FORMAT) -> str:
+    """File name of a backup in the given format, eg. 'backup_20-00-00.tar.zst'"""
+    if format not in FORMATS:
+        raise ValueError(f"Unknown backup format '{format}', use one of: {', '.join(FORMATS)}")
+    return backup_name + FORMATS[format]
+
+
+def check_level(format: str, level: Optional[int]):
+    """Check the compression level before anything is written, zlib and zstd only reject it halfway through a backup"""
+    archive_name("", format)
+    if level is not None and level not in LEVELS[format]:
+        levels = LEVELS[format]
+        raise ValueError(f"Compression level {level} is not valid for the {format} format, use {levels.start} to {levels.stop - 1}")
+
+
+def get_format(path: str | Path) -> Optional[str]:
+    """Get the format of a backup from its name, returns None if it is not a backup archive"""
+    name = str(path)
+    if name.endswith(".tar.zst"):
+        return "tar.zst"
+    if name.endswith(".zip"):
+        return "zip"
+    return None
+
+
+def write_archive(directories: Iterable[str | Path | BackupDirectory], output: Path, workers: int = 1, skip: Iterable[str | Path] = (), mirrors: Iterable[Path] = (), format: str = DEFAULT_FORMAT, level: Optional[int] = None, streams: Iterable[Stream] = ()) -> Path:
+    """Stream every file of the backup directories straight into an archive, without a temporary copy"""
+    directories = [BackupDirectory.parse(directory) for directory in directories]
+    output = output.with_name(archive_name(output.name, format))
+    mirrors = [mirror.with_name(archive_name(mirror.name, format)) for mirror in mirrors]
+    # The archive is written under a temporary name while the directories are walked
+    entries = walk_backup_directories(directories, skip=[partial_path(path) for path in [output, *mirrors]] + list(skip))
+    compression_modes = {directory.name: directory.compression for directory in directories}
+    return write_entries(entries, output, workers=workers, mirrors=mirrors, format=format, level=level, compression_modes=compression_modes, streams=streams)
+
+
+def write_entries(entries: Iterable[tuple[Path, str]], output: Path, workers: int = 1, extra_files: Optional[dict[str, bytes]] = None, mirrors: Iterable[Path] = (), format: str = DEFAULT_FORMAT, level: Optional[int] = None, compression_modes: Optional[dict[str, str]] = None, streams: Iterable[Stream] = ()) -> Path:
+    """
+    Write the given (path, arcname) entries into an archive, extra_files are added first as is.
+    compression_modes can set the compression of a top level folder to auto, deflate or store (zip only).
+    The archive is written to every mirror and stream in the same pass, see FanOutFile.
+    """
+    check_level(format, level)
+    with FanOutFile(output, mirrors, streams) as fp:
+        if format == "tar.zst":
+            files_added = _write_tar_zst(fp, entries, workers, extra_files or {}, level)
+        else:
+            compression = zipfile.ZIP_STORED if format == "zip-stored" else zipfile.ZIP_DEFLATED
+            files_added = _write_zip(fp, entries, workers, extra_files or {}, compression, level, compression_modes or {})
+
+    log.info(f"Added {files_added} files to {output.name}")
+    return output
+
+
+def probe_compressible(path: Path) -> tuple[bool, float]:
+    """
+    Check if deflating a file is worth it, based on its extension and a compressed sample of its start.
+    Returns the decision and an estimate of the CPU seconds that storing the file saves.
+    """
+    size = path.stat().st_size
+    # Files that are known to be compressed are stored without reading them, whatever their size
+    if path.suffix.lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return False, size / DEFLATE_SPEED
+
+    if size < MIN_PROBE_SIZE:
+        return True, 0.0
+
+    with open(path, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+
+    t_beginning = process_time()
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    sample_seconds = process_time() - t_beginning
+
+    if ratio < STORE_RATIO:
+        return True, 0.0
+
+    # Deflate at the default level is a few times slower than level 1, so this is a low estimate
+    return False, sample_seconds * size / len(sample)
+
+
+def choose_compression(path: Path, mode: str, compression: int) -> tuple[bool, Optional[float]]:
+    """
+    Decide if a file is deflated. The mode of its backup directory wins over the format,
+    in auto mode the file is probed. Returns the decision and the seconds saved if the probe chose to store it.
+    """
+    if mode == "store":
+        return False, None
+    if mode == "deflate":
+        return True, None
+    if compression == zipfile.ZIP_STORED:
+        return False, None
+
+    compress, saved = probe_compressible(path)
+    return compress, None if compress else saved
+
+
+def compress_if_worth(path: Path, level: int, mode: str) -> tuple[Optional[tuple[int, int, int, IO[bytes]]], Optional[float]]:
+    """Deflate a file in a worker, returns None instead of the compressed data if it should be stored"""
+    compress, saved = choose_compression(path, mode, zipfile.ZIP_DEFLATED)
+    if not compress:
+        return None, saved
+    return compress_file(path, level), None
+
+
+def _write_zip(fp: FanOutFile, entries: Iterable[tuple[Path, str]], workers: int, extra_files: dict[str, bytes], compression: int, level: Optional[int], compression_modes: dict[str, str]) -> int:
+    """
+    Files that barely compress, like LevelDB tables, images and sounds, are stored instead of deflated.
+    With more than one worker the files are deflated in a thread pool and written in the given order,
+    so the archive is the same no matter how many workers are used.
+    """
+    files_added = 0
+    stored = 0
+    saved_seconds = 0.0
+
+    with zipfile.ZipFile(fp, "w", compression=compression, compresslevel=level) as zf:  # type: ignore
+        for arcname, data in extra_files.items():
+            zf.writestr(arcname, data)
+
+        # Stored files don't need any work, so there is nothing to do in parallel
+        if workers <= 1 or compression == zipfile.ZIP_STORED:
+            for path, arcname in entries:
+                if path.is_dir():
+                    write_file(zf, path, arcname)
+                    continue
+
+                mode = compression_modes.get(arcname.split("/", 1)[0], "auto")
+                compress, saved = choose_compression(path, mode, compression)
+                write_file(zf, path, arcname, zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+                files_added += 1
+                if saved is not None:
+                    stored += 1
+                    saved_seconds += saved
+        else:
+            compress_level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending: deque[tuple[Path, str, Optional[Future[tuple[Optional[tuple[int, int, int, IO[bytes]]], Optional[float]]]]]] = deque()
+
+                for path, arcname in entries:
+                    # Directories have no data, so they are only queued to keep the order
+                    mode = compression_modes.get(arcname.split("/", 1)[0], "auto")
+                    future = None if path.is_dir() else pool.submit(compress_if_worth, path, compress_level, mode)
+                    pending.append((path, arcname, future))
+
+                    # Limit the amount of compressed files waiting to be written
+                    while len(pending) > workers * 4:
+                        added, saved = _write_pending(zf, *pending.popleft())
+                        files_added += added
+                        if saved is not None:
+                            stored += 1
+                            saved_seconds += saved
+
+                while pending:
+                    added, saved = _write_pending(zf, *pending.popleft())
+                    files_added += added
+                    if saved is not None:
+                        stored += 1
+                        saved_seconds += saved
+
+    if stored:
+        log.info(f"Stored {stored} files without compression, saving about {saved_seconds:.1f} seconds of CPU time")
+    return files_added
+
+
+def _write_pending(zf: zipfile.ZipFile, path: Path, arcname: str, future: Optional[Future[tuple[Optional[tuple[int, int, int, IO[bytes]]], Optional[float]]]]) -> tuple[int, Optional[float]]:
+    """Write a queued entry, returns the amount of files added and the seconds saved if the probe chose to store it"""
+    if future is None:
+        write_file(zf, path, arcname)
+        return 0, None
+
+    compressed, saved = future.result()
+    if compressed is None:
+        write_file(zf, path, arcname, zipfile.ZIP_STORED)
+        return 1, saved
+
+    write_compressed_entry(zf, path, arcname, compressed)
+    return 1, None
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The tar.zst backup format needs the zstandard package, install it with 'pip install zstandard'")
+    return zstandard
+
+
+def _write_tar_zst(fp: FanOutFile, entries: Iterable[tuple[Path, str]], workers: int, extra_files: dict[str, bytes], level: Optional[int]) -> int:
+    """Stream a tar through zstd, zstd compresses on multiple threads by itself"""
+    zstandard = _zstandard()
+    compressor = zstandard.ZstdCompressor(level=ZSTD_DEFAULT_LEVEL if level is None else level, threads=workers if workers > 1 else 0, write_checksum=True)
+    files_added = 0
+
+    with compressor.stream_writer(fp, closefd=False) as writer, tarfile.open(fileobj=writer, mode="w|", dereference=True) as tar:  # type: ignore
+        for arcname, data in extra_files.items():
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.size = len(data)
+            tar.addfile(tarinfo, io.BytesIO(data))
+
+        for path, arcname in entries:
+            tarinfo = tar.gettarinfo(path, arcname)
+            if not tarinfo.isreg():
+                tar.addfile(tarinfo)
+                continue
+            # Read at the rate limit of throttled jobs, like the zip formats
+            with ThrottledReader(path) as f:
+                tar.addfile(tarinfo, f)  # type: ignore
+            files_added += 1
+
+    return files_added
+
+
+@contextmanager
+def open_tar_zst(archive: Path) -> Iterator[tarfile.TarFile]:
+    zstandard = _zstandard()
+    with open(archive, "rb") as f, zstandard.ZstdDecompressor().stream_reader(f) as reader, tarfile.open(fileobj=reader, mode="r|") as tar:  # type: ignore
+        yield tar
+
+
+def read_member(archive: Path, name: str) -> Optional[bytes]:
+    """Read a single file from a backup archive, returns None if it isn't in the archive"""
+    if get_format(archive) == "tar.zst":
+        # Extra files are written first, so only the start of the stream is read for them
+        with open_tar_zst(archive) as tar:
+            for member in tar:
+                if member.name == name:
+                    return tar.extractfile(member).read()  # type: ignore
+        return None
+
+    with zipfile.ZipFile(archive) as zf:
+        if name not in zf.NameToInfo:
+            return None
+        return zf.read(name)
+
+
+def in_prefixes(name: str, prefixes: Optional[Iterable[str]]) -> bool:
+    """Check if an archive name is one of the prefixes or inside one of them, no prefixes means everything"""
+    return prefixes is None or any(name.rstrip("/") == prefix or name.startswith(prefix + "/") for prefix in prefixes)
+
+
+def extract_archive(archive: Path, destination: Path, skip: Iterable[str] = (), workers: int = 1, prefixes: Optional[Iterable[str]] = None):
+    """
+    Extract every file of a backup archive except the skipped names, with prefixes only the files inside them.
+    Files of a zip are extracted on multiple threads, every thread has its own handle to the archive.
+    """
+    skipped = set(skip)
+    prefixes = list(prefixes) if prefixes is not None else None
+
+    if get_format(archive) == "tar.zst":
+        with open_tar_zst(archive) as tar:
+            for member in tar:
+                if member.name not in skipped and in_prefixes(member.name, prefixes):
+                    tar.extract(member, destination, filter="data")
+        return
+
+    with zipfile.ZipFile(archive) as zf:
+        infos = [info for info in zf.infolist() if info.filename not in skipped and in_prefixes(info.filename, prefixes)]
+
+        if workers <= 1:
+            zf.extractall(destination, infos)
+            return
+
+    # Folders are made up front, so the threads never create the same folder at once
+    for info in infos:
+        folder = info.filename if info.is_dir() else os.path.dirname(info.filename)
+        (destination / folder).mkdir(parents=True, exist_ok=True)
+
+    local = threading.local()
+    handles: list[zipfile.ZipFile] = []
+    lock = threading.Lock()
+
+    def extract(info: zipfile.ZipInfo):
+        if not hasattr(local, "zf"):
+            local.zf = zipfile.ZipFile(archive)
+            with lock:
+                handles.append(local.zf)
+        local.zf.extract(info, destination)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # list() raises the first error of the threads
+            list(pool.map(extract, [info for info in infos if not info.is_dir()]))
+    finally:
+        for handle in handles:
+            handle.close()
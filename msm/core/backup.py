@@ -1,11 +1,23 @@
 import os
 import datetime
-import subprocess
-from time import monotonic
-from msm.config.load_config import Config
-import shutil
 import tempfile
-from typing import Optional
+import dataclasses
+from msm.config.load_config import Config, BackupDirectory
+from msm.core.archive import write_archive, archive_name, check_level, get_format, FORMATS, DEFAULT_FORMAT
+from msm.core.incremental import generate_incremental_archive, incremental_size, save_state
+from msm.core.repository import REPOSITORY_DIR, create_snapshot, snapshot_size, sync_repository, collect_garbage
+from msm.core.hot_backup import stage_hot_backup
+from msm.core.policies import due_directories, mark_backed_up
+from msm.core.precopy import final_pass, remove_staging
+from msm.core.verify import verify_archive
+from msm.core.index import update_index
+from msm.core.catalog import set_source_size
+from msm.core.upload import StreamUpload, UploadSettings
+from msm.core.drive_sync import drive_remote, record_streamed_backup, sync_drive
+from msm.core.replicate import replicate
+from msm.core.fanout import Stream
+from msm.core.clear_backup import ensure_space, source_size
+from typing import Callable, Optional
 from pathlib import Path
 import logging
 
@@ -20,60 +32,53 @@ def generate_file_name(cfg: Config):
     folder_name = date.strftime("%Y-%m-%d")
     backup_name = date.strftime('backup_%H-%M-%S')
 
-    log.info(f"Name of the file will be: '{backup_name}.zip'")
+    log.info(f"Name of the file will be: '{archive_name(backup_name, cfg.backup_format or DEFAULT_FORMAT)}'")
 
     return backup_name, folder_name
 
 
-def generate_zip(cfg: Config, backup_name: str) -> Optional[Path]:
-    """Generate a zip file from the backup directories"""
-    if cfg.backup_directories and cfg.path_base:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            
-            # Move all directories into temporary folder
-            for directory in cfg.backup_directories:
-                directory = Path(directory)
-                temp_dest = os.path.join(temp_dir, directory.name)
-                shutil.copytree(directory, temp_dest)
-
-            # Make zip file in main folder
-            backup_location = Path(os.path.join(cfg.path_base, backup_name))
-            shutil.make_archive(str(backup_location), "zip", root_dir=temp_dir)
-            backup_path = backup_location.with_suffix('.zip')
-
-            log.info(f"Zip file generated: {backup_path}")
-            return backup_path
-    else:
-        log.warning("There are no backup directories or base path defined")
-        return None
+def get_workers(cfg: Config) -> int:
+    """Amount of threads used for compressing, every core by default"""
+    return cfg.backup_workers or os.cpu_count() or 1
 
 
-def backup_drive(cfg: Config, backup_symlink: Path, folder: str, filename: str):
-    t_beginning = monotonic()
-    # Create the backup folder
-    subprocess.run(["rclone", "mkdir", f"{cfg.backup_drive_name}{folder}"])
-    log.info(f"Made folder for backup: {folder}")
+def generate_archive(cfg: Config, backup_name: str, backup_folders: list[Path], directories: list[BackupDirectory], open_stream: Optional[Callable[[str], Stream]] = None) -> Optional[Path]:
+    """Generate an archive from the backup directories, written to every backup folder and the stream in one pass"""
+    if directories and cfg.path_base:
+        # Stream all directories straight into the archive in the first folder and mirror it to the others
+        backup_location = backup_folders[0] / backup_name
+        mirrors = [folder / backup_name for folder in backup_folders[1:]]
+        format = cfg.backup_format or DEFAULT_FORMAT
+        streams = [open_stream(archive_name(backup_name, format))] if open_stream else []
+        backup_path = write_archive(directories, backup_location, workers=get_workers(cfg), mirrors=mirrors, format=format, level=cfg.backup_level, streams=streams)
 
-    # Get the actual path from the symlink
-    backup_path = os.path.realpath(backup_symlink)
+        log.info(f"Archive generated: {backup_path}")
+        return backup_path
+    else:
+        log.warning("There are no backup directories or base path defined")
+        return None
 
-    log.info("Starting upload to drive...")
-    
-    # Upload to drive via rclone
-    subprocess.run(["rclone", "copyto", backup_path, f"{cfg.backup_drive_name}{folder}/{filename}"])
 
-    log.info(f"Drive upload successful, took {monotonic()-t_beginning:.1f} seconds")
+def get_latest_backup(cfg: Config) -> Optional[Path]:
+    """Get the latest backup symlink, its extension depends on the format of the latest backup"""
+    for extension in set(FORMATS.values()):
+        symlink = Path(os.path.join(cfg.path_base, f"latest_backup{extension}"))  # type: ignore
+        if symlink.is_symlink():
+            return symlink
+    return None
 
 
 def update_sym_link(cfg: Config, backup_path: Path):
     location = cfg.path_base
 
     if location:
-        symlink = os.path.join(location, "latest_backup.zip")
+        symlink = os.path.join(location, f"latest_backup{FORMATS[get_format(backup_path) or DEFAULT_FORMAT]}")
 
-        # Check if symlink already exists
-        if os.path.islink(symlink):
-            os.unlink(symlink)
+        # Check if a symlink already exists, also when the previous backup had another format
+        for extension in set(FORMATS.values()):
+            old_symlink = os.path.join(location, f"latest_backup{extension}")
+            if os.path.islink(old_symlink):
+                os.unlink(old_symlink)
 
         # Save latest backup to a symlink, so it can be accessed later for the drive backup
         os.symlink(backup_path, symlink)
@@ -82,7 +87,37 @@ def update_sym_link(cfg: Config, backup_path: Path):
         raise ValueError("Base path is not defined")
 
 
-def quick_backup(cfg: Config):
+def repository_backup(cfg: Config, backup_name: str, folder_name: str, locations: list[Path], directories: list[BackupDirectory], skipped: list[BackupDirectory]):
+    """Store a deduplicated snapshot in the first repository and copy its new chunks to the other one"""
+    snapshot_id = f"{folder_name}_{backup_name}"
+
+    # The world is only read once, the other repository gets the chunks from the first one
+    repository = locations[0] / REPOSITORY_DIR
+    # Skipped directories are kept as they were in the previous snapshot
+    try:
+        create_snapshot(repository, directories, snapshot_id, workers=get_workers(cfg), keep=[directory.name for directory in skipped])
+    except Exception:
+        # The chunks written so far are not part of any snapshot
+        collect_garbage(repository)
+        raise
+
+    for location in locations[1:]:
+        sync_repository(repository, location / REPOSITORY_DIR, snapshot_id)
+
+
+def backup_size(cfg: Config, directories: list[BackupDirectory], skipped: list[BackupDirectory]) -> tuple[int, bool]:
+    """Size of the files the next backup stores and if it is an incremental backup, only the metadata is read"""
+    locations = [Path(location) for location in [cfg.backup_local_path, cfg.backup_hdd_path] if location]
+    if cfg.backup_repository:
+        return snapshot_size(locations[0] / REPOSITORY_DIR, directories), False
+    if cfg.backup_incremental:
+        # Before it is known which locations have room, so a location that could be left out can still make it full
+        size, full = incremental_size(cfg, locations, directories, skipped)
+        return size, not full
+    return source_size(directories), False
+
+
+def quick_backup(cfg: Config, stream_upload: bool = True):
     log.info("Starting local and hdd backup")
 
     # Check if directories exist and if local backup doesn't, it creates it
@@ -95,54 +130,133 @@ def quick_backup(cfg: Config):
     # Generate name and a folder with today's date, if it doesn't exist already from an earlier backup
     backup_name, folder_name = generate_file_name(cfg)
 
-    # Check if backup locations and folders exist and create them if the don't
-    for backup_location in [cfg.backup_local_path, cfg.backup_local_path]:
-        if backup_location:
-            backup_folder = os.path.join(backup_location, folder_name)
-            if not os.path.exists(backup_folder):
-                os.makedirs(backup_folder)
-                log.info(f"Created backup folder for today: '{backup_folder}'")
+    # Directories with a daily or weekly frequency are only backed up when they are due
+    directories, skipped = due_directories(cfg)
+    if not directories:
+        log.info("None of the backup directories are due, skipping the backup")
+        return
 
-    # Generate a zip file at a predictable location
-    temp_backup_path = generate_zip(cfg, backup_name)
+    # A wrong format or level in the config fails here, before backups are removed to make room
+    if not cfg.backup_repository:
+        check_level(cfg.backup_format or DEFAULT_FORMAT, cfg.backup_level)
 
-    if not temp_backup_path:
+    # Room for the backup is made before anything is written, so a full disk can't stop it halfway.
+    # A location without enough room is left out, the backup is still written to the others
+    size, incremental = backup_size(cfg, directories, skipped)
+    locations = ensure_space(cfg, size, incremental)
+    if not locations:
+        log.error("Not enough free space for the backup, skipping the backup")
         return
 
-    # Copy the temp backup to the local folder and/or the hdd folder
-    if cfg.backup_local_path:
-        backup_folder = os.path.join(cfg.backup_local_path, folder_name)
-        if not Path(backup_folder).exists():
-            Path(backup_folder).mkdir(parents=True)
-        shutil.copy(temp_backup_path, backup_folder)
-        update_sym_link(cfg, temp_backup_path)  # Update symlink for later backups
+    if cfg.backup_repository:
+        repository_backup(cfg, backup_name, folder_name, locations, directories, skipped)
+        mark_backed_up(cfg, directories)
+        return
 
-    if cfg.backup_hdd_path:
-        backup_folder = os.path.join(cfg.backup_hdd_path, folder_name)
-        if not Path(backup_folder).exists():
-            Path(backup_folder).mkdir(parents=True)
-        shutil.copy(temp_backup_path, backup_folder)
+    # Check if backup folders exist and create them if the don't
+    backup_folders: list[Path] = []
+    for backup_location in locations:
+        backup_folder = backup_location / folder_name
+        if not backup_folder.exists():
+            backup_folder.mkdir(parents=True)
+            log.info(f"Created backup folder for today: '{backup_folder}'")
+        backup_folders.append(backup_folder)
+
+    # With a streaming upload the archive is piped to the drive while it is written, the name is only known by then
+    uploads: list[StreamUpload] = []
+    open_stream: Optional[Callable[[str], Stream]] = None
+    if stream_upload and cfg.backup_drive_name and UploadSettings.parse(cfg.backup_upload).stream:
+        def start_upload(file_name: str) -> StreamUpload:
+            uploads.append(StreamUpload(cfg, drive_remote(cfg, backup_folders[0] / file_name)))
+            return uploads[-1]
+        open_stream = start_upload
+
+    # Generate the archive once, it is written to the local folder and/or the hdd folder at the same time
+    incremental_state = None
+    if cfg.backup_incremental:
+        backup_path, incremental_state, directories = generate_incremental_archive(cfg, backup_name, folder_name, backup_folders, directories, skipped, workers=get_workers(cfg), open_stream=open_stream)
+    else:
+        backup_path = generate_archive(cfg, backup_name, backup_folders, directories, open_stream=open_stream)
 
+    if not backup_path:
+        return
 
-def drive_backup(cfg: Config):
-    """Upload the latest backup to an online drive"""
+    # The upload only has to finish sending what is still buffered, a failed stream is left to the drive backup
+    for upload in uploads:
+        if upload.finish(backup_path):
+            record_streamed_backup(cfg, backup_path, upload.name)
+        else:
+            log.error("Streaming drive upload failed, the drive backup will try again")
 
-    # The backup is from the day before, so this is calculated
-    backup_date = datetime.datetime.now() - datetime.timedelta(days=1)
-    folder = backup_date.strftime("backup/%y-%m-%d")
-    filename = backup_date.strftime("backup_%H-%M-%S.zip")
+    # Every copy is checked, a mirror on another drive can be corrupt while the first copy is fine
+    if cfg.backup_verify:
+        for folder in backup_folders:
+            if (folder / backup_path.name).exists():
+                verify_archive(folder / backup_path.name, workers=get_workers(cfg))
 
-    if cfg.backup_local_path:
-        # Get backup zip from latest backup symlink
-        latest_backup_path = Path(os.path.join(cfg.backup_local_path, "latest_backup.zip")) 
-        backup_drive(cfg, latest_backup_path, folder, filename)
-    else:
-        raise ValueError("Local backup is not defined")
+    # Add the new backup to the catalog and file index of every location, backups removed since the last time are dropped
+    for folder in backup_folders:
+        try:
+            update_index(folder.parent)
+            # Used to estimate the size of the next backup
+            set_source_size(folder / backup_path.name, size)
+        except Exception as e:
+            log.error(f"Could not update the backup index of {folder.parent}: {e}")
+
+    if cfg.backup_local_path and backup_folders[0].parent == Path(cfg.backup_local_path):
+        update_sym_link(cfg, backup_path)  # Update symlink for later backups
+
+    # The next incremental backup is only based on this one once it is stored
+    if incremental_state:
+        save_state(cfg, incremental_state)
+    mark_backed_up(cfg, directories)
+
+
+def hot_backup(cfg: Config):
+    """Back up while the server is running, the world is copied while the server holds its saves"""
+    log.info("Starting hot backup")
+
+    with tempfile.TemporaryDirectory(prefix="bsm_hot_", dir=cfg.path_base) as staging:
+        staged_directories = stage_hot_backup(cfg, Path(staging))
+
+        # The staged copy has the same folder names, so the backup looks like a normal one
+        staged_cfg = dataclasses.replace(cfg, backup_directories=staged_directories)
+        # Hot backups are made often, so they are not uploaded
+        quick_backup(staged_cfg, stream_upload=False)
+
+
+def precopied_backup(cfg: Config):
+    """Back up from the copy staged during the shutdown countdown, only the changes since then are copied now"""
+    log.info("Starting backup from the pre-copied directories")
+
+    try:
+        staged_directories = final_pass(cfg)
+
+        # The staged copy has the same folder names, so the backup looks like a normal one
+        staged_cfg = dataclasses.replace(cfg, backup_directories=staged_directories)
+        quick_backup(staged_cfg)
+    finally:
+        remove_staging(cfg)
+
+
+def drive_backup(cfg: Config):
+    """Upload the backups of the last days that are not on the online drive yet, or only the changed files"""
+    log.info("Starting upload to drive...")
+    if UploadSettings.parse(cfg.backup_upload).replicate:
+        # The server is stopped for the drive backup, so the directories are uploaded as they are
+        replicate(cfg)
+    elif sync_drive(cfg):
+        raise OSError("Not every backup could be uploaded to the drive")
+    log.info("Drive upload successful")
 
 
 def main(cfg: Config, type: str = "quick"):
     "Check if a backup to hard drive or to the cloud is needed"
     if type == "quick":
         quick_backup(cfg)
+    elif type == "hot":
+        hot_backup(cfg)
+    elif type == "precopied":
+        precopied_backup(cfg)
     elif type == "drive":
         drive_backup(cfg)
@@ -0,0 +1,194 @@
+import os
+import json
+import sqlite3
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional
+from msm.core.archive import get_format
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+# Every backup location has its own catalog, backups are named by their path in it, eg. "2025-03-24/backup_20-00-00.zip"
+CATALOG_FILE = "backup_catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id TEXT PRIMARY KEY,
+    destination TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    hash TEXT,
+    verified INTEGER,
+    verified_at TEXT,
+    indexed INTEGER NOT NULL DEFAULT 0,
+    source_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS backups_timestamp ON backups(timestamp);
+CREATE TABLE IF NOT EXISTS folders (
+    name TEXT PRIMARY KEY,
+    mtime INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT NOT NULL,
+    backup_id TEXT NOT NULL REFERENCES backups(id) ON DELETE CASCADE,
+    size INTEGER NOT NULL,
+    crc INTEGER,
+    PRIMARY KEY (path, backup_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_backup ON entries(backup_id);
+"""
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    id: str
+    path: Path
+    size: int
+    timestamp: datetime
+    hash: Optional[str]
+    verified: Optional[bool]
+    source_size: Optional[int]
+
+    @property
+    def incremental(self) -> bool:
+        return "_incr." in self.path.name
+
+
+def backup_date(folder: str, name: str) -> Optional[datetime]:
+    """Date of a backup from its folder and name, eg. '2025-03-24' and 'backup_20-00-00_incr.zip'"""
+    try:
+        day = datetime.strptime(folder, "%Y-%m-%d")
+    except ValueError:
+        return None
+    try:
+        time = datetime.strptime(name.split(".")[0][len("backup_"):len("backup_") + 8], "%H-%M-%S")
+        return day.replace(hour=time.hour, minute=time.minute, second=time.second)
+    except ValueError:
+        return day
+
+
+def connect(location: str | Path) -> sqlite3.Connection:
+    connection = sqlite3.connect(Path(location) / CATALOG_FILE)
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.execute("PRAGMA journal_mode = WAL")
+    # The catalog can always be rebuilt from the backups, so commits don't wait for the disk
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def backup_id(location: str | Path, archive: Path) -> str:
+    return Path(os.path.relpath(archive, location)).as_posix()
+
+
+def _verification(archive: Path) -> tuple[Optional[bool], Optional[str]]:
+    """Verification result saved next to the backup, see verify.py"""
+    result_path = archive.with_name(archive.name + ".verify.json")
+    if not result_path.exists():
+        return None, None
+    result: dict[str, Any] = json.loads(result_path.read_text())
+    return result["ok"], result["verified"]
+
+
+def reconcile(location: str | Path) -> tuple[int, int]:
+    """
+    Bring the catalog up to date with the disk in a single scandir pass. Date folders whose mtime didn't change
+    have the same backups as last time, so they are not listed again. Returns the amount of added and removed backups.
+    """
+    location = Path(location)
+    added = 0
+    removed = 0
+
+    with closing(connect(location)) as connection, connection:
+        folders = dict(connection.execute("SELECT name, mtime FROM folders").fetchall())
+        on_disk: set[str] = set()
+
+        for folder in os.scandir(location):
+            # Other folders, like the repository, are skipped without being scanned
+            if not folder.is_dir() or backup_date(folder.name, "") is None:
+                continue
+            on_disk.add(folder.name)
+
+            mtime = folder.stat().st_mtime_ns
+            if folders.get(folder.name) == mtime:
+                continue
+
+            known = {row[0]: (row[1], row[2]) for row in connection.execute("SELECT id, size, mtime FROM backups WHERE id >= ? AND id < ?", (folder.name + "/", folder.name + "0"))}
+            found: set[str] = set()
+            for entry in os.scandir(folder.path):
+                if not entry.is_file() or not get_format(entry.name):
+                    continue
+                archive_id = f"{folder.name}/{entry.name}"
+                found.add(archive_id)
+                stat = entry.stat()
+                if known.get(archive_id) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+
+                # New or rewritten, so the hash and file index of an older version are dropped
+                verified, verified_at = _verification(Path(entry.path))
+                connection.execute("DELETE FROM backups WHERE id = ?", (archive_id,))
+                connection.execute(
+                    "INSERT INTO backups (id, destination, path, size, mtime, timestamp, verified, verified_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (archive_id, str(location), entry.path, stat.st_size, stat.st_mtime_ns, backup_date(folder.name, entry.name).isoformat(), verified, verified_at)  # type: ignore
+                )
+                added += 1
+
+            gone = set(known) - found
+            connection.executemany("DELETE FROM backups WHERE id = ?", ((archive_id,) for archive_id in gone))
+            removed += len(gone)
+            connection.execute("INSERT OR REPLACE INTO folders VALUES (?, ?)", (folder.name, mtime))
+
+        # Date folders that were removed as a whole
+        for name in set(folders) - on_disk:
+            removed += connection.execute("DELETE FROM backups WHERE id >= ? AND id < ?", (name + "/", name + "0")).rowcount
+            connection.execute("DELETE FROM folders WHERE name = ?", (name,))
+
+    return added, removed
+
+
+def list_backups(location: str | Path) -> list[CatalogEntry]:
+    """Every backup in a location, oldest first"""
+    with closing(connect(location)) as connection:
+        rows = connection.execute("SELECT id, path, size, timestamp, hash, verified, source_size FROM backups ORDER BY timestamp, id").fetchall()
+    return [
+        CatalogEntry(archive_id, Path(path), size, datetime.fromisoformat(timestamp), file_hash, None if verified is None else bool(verified), source_size)
+        for archive_id, path, size, timestamp, file_hash, verified, source_size in rows
+    ]
+
+
+def latest_backup(location: str | Path) -> Optional[Path]:
+    with closing(connect(location)) as connection:
+        row = connection.execute("SELECT path FROM backups ORDER BY timestamp DESC, id DESC LIMIT 1").fetchone()
+    return Path(row[0]) if row else None
+
+
+def set_hashes(location: str | Path, hashes: dict[str, str]):
+    with closing(connect(location)) as connection, connection:
+        connection.executemany("UPDATE backups SET hash = ? WHERE id = ?", ((file_hash, archive_id) for archive_id, file_hash in hashes.items()))
+
+
+def set_source_size(archive: Path, source_size: int):
+    """Save the size of the files a backup was made from, to estimate the size of the next backup of its kind"""
+    location = archive.parent.parent
+    with closing(connect(location)) as connection, connection:
+        connection.execute("UPDATE backups SET source_size = ? WHERE id = ?", (source_size, backup_id(location, archive)))
+
+
+def set_verification(archive: Path, ok: bool, verified_at: str):
+    """Save a verification result, backups are always in a date folder of their location"""
+    location = archive.parent.parent
+    if not (location / CATALOG_FILE).exists():
+        return
+    with closing(connect(location)) as connection, connection:
+        connection.execute("UPDATE backups SET verified = ?, verified_at = ? WHERE id = ?", (ok, verified_at, backup_id(location, archive)))
+
+
+def remove_backups(location: str | Path, archives: list[Path]):
+    with closing(connect(location)) as connection, connection:
+        connection.executemany("DELETE FROM backups WHERE id = ?", ((backup_id(location, archive),) for archive in archives))
@@ -1,177 +1,246 @@
 import os
 import psutil
-from datetime import datetime
-from msm.config.load_config import Config
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Optional
+from msm.config.load_config import Config, BackupDirectory
 from pathlib import Path
-from typing import Iterable
+from msm.core.archive import changed_size
+from msm.core.repository import clear_old_snapshots, collect_garbage, get_repository
+from msm.core.verify import result_path
+import msm.core.catalog as catalog
+from msm.core.incremental import hash_file
+from msm.core.retention import Backup, RetentionPolicy, read_inventory, plan_retention, protected_backups
 import logging
 
 # Get logger
 log = logging.getLogger("bsm")
 
+# Amount of recent full backups the compression ratio of the next backup is estimated from
+RECENT_BACKUPS = 5
 
-def get_backup_folders(location: Path):
-    """Gets every folder in the location and sorts them"""
-    backup_folders = sorted(folder for folder in os.listdir(location) if os.path.isdir(os.path.join(location, folder)))
-    return backup_folders
 
-
-def get_sorted_list(base_path: Path, backup_folders: Iterable[str]) -> dict[str, list[Path]]:
+@dataclass(frozen=True)
+class SpacePolicy:
     """
-    Function wil return a dictionary with dates
-    and their the backups in a list eg. "24-03-2025":["backup1", "backup2"]
+    Free space in GB every backup location keeps next to the next backup, in the config under 'space':
+    {local: 30, hdd: 50, margin: 1.2}. The estimated size of the next backup is multiplied by the margin.
     """
-    backup_per_date: dict[str, list[Path]] = {}
-    for folder in backup_folders:
-        folder_path = base_path / folder
-        if not folder_path.is_dir():
-            continue
-        backups = [Path(p.name) for p in sorted(folder_path.iterdir()) if p.is_file()]
-        backup_per_date[folder] = backups
-    return backup_per_date
-
-
-def remove_oldest_backup(backup_dates: Iterable[str], backup_per_date: dict[str, list[Path]], base_path: Path, freed_space: float):
-    for date in backup_dates:
-        if len(backup_per_date[date]) > 1:
-            oldest_backup_date = date
-            oldest_backups = sorted(backup_per_date[oldest_backup_date])
-            oldest_backup = oldest_backups[0]
-
-            oldest_backup_path = os.path.join(base_path, oldest_backup_date, oldest_backup)
-            oldest_backup_size = os.path.getsize(oldest_backup_path) / (1024 ** 3)
-
-            log.info(f"\nRemoving old backup from {oldest_backup_date} folder: {oldest_backups}")
-            log.info(f"Oldest backup: {oldest_backup} ({oldest_backup_size:.2f} GB)")
-            log.info(f"Removing old backup: {oldest_backup_date} at {oldest_backup}")
-            os.remove(oldest_backup_path)
-            freed_space += oldest_backup_size
-            #  Remove the backup from the dictionary to avoid trying to delete it again
-            backup_per_date[oldest_backup_date].remove(oldest_backup)
-            return freed_space  # Only remove one file per function call
-
-    return freed_space
-
-
-def clear_old_backups(backup_per_date: dict[str, list[Path]], required_free_space: float, base_path: Path):
-    """Function will remove old backups based on the folder name (the date) and name of the backup (the time).
-    The backup_per_date is a dictionary in this format: "24-03-2025":["backup1", "backup2"]"""
-
-    all_dates = backup_per_date.keys()
-
-    last_7_days: list[str] = []
-    last_30_days: list[str] = []
-    old_backups: list[str] = []
-
-    amount_backups_last_7 = 0
-    amount_backups_last_30 = 0
-    amount_backups_old = 0
-
-    freed_space = 0
-
-    for date in all_dates:
-        date_object = datetime.strptime(date, "%Y-%m-%d")
-        current_date = datetime.now()
-        backup_age = (current_date - date_object).days
-        
-        if backup_age <= 7:
-            last_7_days.append(date)
-        elif backup_age <= 30:
-            last_30_days.append(date)
-        else:
-            old_backups.append(date)
-
-    log.info(f"Last 7 days backups: {last_7_days} with a total of {amount_backups_last_7} backups")
-    log.info(f"Last 30 days backups: {last_30_days} with a total of {amount_backups_last_30} backups")
-    log.info(f"Old backups: {old_backups} with a total of {amount_backups_old} backups")
-
-    previous_freed_space = -1
-
-    while freed_space < required_free_space:
-        # Check to prevent infinite loops
-        if freed_space == previous_freed_space:
-            log.info(f"No more space can be freed. Current freed space: {freed_space:.2f} GB, Required: {required_free_space:.2f} GB")
-            break
-        previous_freed_space = freed_space
-
-        if old_backups:
-            directory = old_backups
-        elif last_30_days:
-            directory = last_30_days
-        elif freed_space < required_free_space:
-            log.error("No more old backups to remove, but not enough space freed.")
-            break
-        else:
-            directory = None
+    local: float = 30
+    hdd: float = 50
+    margin: float = 1.2
 
-        if directory is not None:
-            freed_space = remove_oldest_backup(directory, backup_per_date, base_path, freed_space)
-    log.info(f"Total freed space: {freed_space:.2f} GB")
+    @classmethod
+    def parse(cls, entry: Optional[dict[str, Any]]) -> "SpacePolicy":
+        policy = cls(**(entry or {}))
+        if min(policy.local, policy.hdd) < 0 or policy.margin < 1:
+            raise ValueError("Free space can't be negative and the margin can't be below 1")
+        return policy
 
 
-def clear_duplicate_files(backup_folders: Iterable[str], base_path: Path, backup_per_date: dict[str, list[Path]]):
-    """Function will check for duplicate files in the backup folders
-    based on size and remove them"""
+def remove_backups(location: Path, backup_paths: list[Path]):
+    """Remove backups together with their verification results, the catalog is updated once for all of them"""
+    for backup_path in backup_paths:
+        os.remove(backup_path)
+        if result_path(backup_path).exists():
+            os.remove(result_path(backup_path))
+    catalog.remove_backups(location, backup_paths)
 
-    size_list: list[int] = []
-    duplicates = 0
 
-    for folder in backup_folders:
-        folder_path = os.path.join(base_path, folder)
-        backups = os.listdir(folder_path)
+def clear_corrupt_backups(location: Path) -> float:
+    """Remove the backups that failed verification, they can't be restored anyway. Returns the freed space in GB"""
+    corrupt = [backup for backup in catalog.list_backups(location) if backup.verified is False]
+    for backup in corrupt:
+        log.info(f"Removing corrupt backup: {backup.id} ({backup.size / (1024 ** 3):.2f} GB)")
+    remove_backups(location, [backup.path for backup in corrupt])
+    return sum(backup.size for backup in corrupt) / (1024 ** 3)
 
-        for backup in backups:
-            backup_path = os.path.join(folder_path, backup)
-            size = os.path.getsize(backup_path)
 
-            file_new = size not in size_list
+def clear_old_backups(location: Path, required_free_space: float, policy: RetentionPolicy, dry_run: bool = False) -> float:
+    """
+    Remove the oldest backups the retention policy doesn't keep until enough space is freed.
+    The backups are read once and the whole plan is made before anything is removed. Returns the freed space in GB.
+    """
+    backups = read_inventory(location)
+    plan, freed = plan_retention(backups, policy, int(required_free_space * 1024 ** 3))
+    log.info(f"{len(backups)} backups, {len(plan)} will be removed to free {freed / (1024 ** 3):.2f} GB of the required {required_free_space:.2f} GB")
 
-            if file_new:
-                size_list.append(size)
+    if dry_run:
+        for backup in plan:
+            log.info(f"Would remove {backup.path} ({backup.size / (1024 ** 3):.2f} GB)")
+    else:
+        remove_backups(location, [backup.path for backup in plan])
+
+    if freed < required_free_space * 1024 ** 3:
+        log.error("No more old backups to remove, but not enough space freed.")
+    log.info(f"Total {'space that would be freed' if dry_run else 'freed space'}: {freed / (1024 ** 3):.2f} GB")
+    return freed / (1024 ** 3)
+
+
+def clear_duplicate_files(location: Path, workers: int = 1, policy: RetentionPolicy = RetentionPolicy()) -> int:
+    """Function will check for duplicate files in the backup location,
+    backups with the same size are compared by the hash of their content and only the oldest one is kept.
+    Backups the retention policy keeps and backups a later incremental backup is based on are never removed"""
+    backups = catalog.list_backups(location)
+    kept = protected_backups([Backup(backup.path, backup.timestamp, backup.size, backup.incremental) for backup in backups], policy)
+    # An incremental backup is always based on the backup before it, even when their content is the same
+    kept.update(backup.path for backup, following in zip(backups, backups[1:]) if following.incremental)
+
+    # Only backups that share their size with another backup can be duplicates, so only those are hashed
+    backups_per_size: dict[int, list[catalog.CatalogEntry]] = defaultdict(list)
+    for backup in backups:
+        backups_per_size[backup.size].append(backup)
+    # Groups where every later backup has to be kept anyway are not worth hashing
+    groups = {size: group for size, group in backups_per_size.items() if any(backup.path not in kept for backup in group[1:])}
+
+    # Hashes are saved in the catalog, so backups are only read once
+    to_hash = [backup for group in groups.values() for backup in group if backup.hash is None]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        hashes = dict(zip((backup.id for backup in to_hash), pool.map(lambda backup: hash_file(backup.path), to_hash)))
+    catalog.set_hashes(location, hashes)
+    if to_hash:
+        log.info(f"Hashed {len(to_hash)} backups with the same size as another backup")
+
+    duplicates: list[Path] = []
+    for size, group in groups.items():
+        seen: set[str] = set()
+        for backup in group:
+            backup_hash = backup.hash or hashes[backup.id]
+            if backup_hash not in seen:
+                seen.add(backup_hash)
+                continue
+            if backup.path in kept:
+                log.info(f"Keeping duplicate {backup.path}, it is kept by the retention policy or part of a chain")
+                continue
+
+            log.info(f"Duplicate found, removing {backup.path} with size {size/(1024**3):.2f} GB")
+            duplicates.append(backup.path)
+
+    remove_backups(location, duplicates)
+    return len(duplicates)
+
+
+def clear_backups(location: Path, required_free_space: float, workers: int = 1, policy: RetentionPolicy = RetentionPolicy(), dry_run: bool = False):
+
+    # Snapshots in a repository are removed first, since they are the main backups when a repository is used
+    repository = get_repository(location)
+
+    if dry_run:
+        # Only the retention plans are shown, unused chunks, corrupt backups and duplicates are left alone
+        if repository:
+            required_free_space -= clear_old_snapshots(repository, required_free_space, policy, dry_run=True)
+        clear_old_backups(location, max(0.0, required_free_space), policy, dry_run=True)
+        return
+
+    if repository:
+        # Chunks of an interrupted snapshot are not used by any snapshot, they are removed before any snapshot is
+        required_free_space -= collect_garbage(repository) / (1024 ** 3)
+        if required_free_space <= 0:
+            return
+        required_free_space -= clear_old_snapshots(repository, required_free_space, policy)
+        if required_free_space <= 0:
+            return
+
+    # The catalog is brought up to date once, every step after this only queries it
+    catalog.reconcile(location)
+
+    # Corrupt backups go first, before any good backup is removed
+    required_free_space -= clear_corrupt_backups(location)
+
+    duplicates_amount = clear_duplicate_files(location, workers, policy)
+    clear_old_backups(location, required_free_space, policy)
 
-            else:
-                log.info("Duplicate found")
-                duplicates += 1
-                os.remove(backup_path)
-                log.info(f"Removed {backup_path} with size {size/(1024**3):.2f} GB")
+    log.info(f"There are a total of {duplicates_amount} duplicate files found, all of them were removed")
 
-                # Remove the backup from the dictionary to keep it in sync
-                if folder in backup_per_date and Path(backup) in backup_per_date[folder]:
-                    backup_per_date[folder].remove(Path(backup))
 
-    return duplicates
+def check_and_clear(location: Path, min_free_gb: float, name: str, workers: int = 1, policy: RetentionPolicy = RetentionPolicy()) -> bool:
+    """Free space until at least min_free_gb is left, returns if there is enough space now"""
+    space_left = psutil.disk_usage(str(location)).free / (1024 ** 3)
 
+    log.info(f"{name} free space: {space_left:.2f} GB")
 
-def clear_backups(location: Path, required_free_space: float):
+    if space_left < min_free_gb:
+        log.info(f"Less than {min_free_gb:.2f} GB left on {name}, clearing backup's...")
+        required_free_space = min_free_gb - space_left  # in GB
+        clear_backups(location, required_free_space, workers, policy)
+        space_left = psutil.disk_usage(str(location)).free / (1024 ** 3)
+        return space_left >= min_free_gb
+    else:
+        log.info(f"More than {min_free_gb:.2f} GB left on {name}, no need to clear backups.")
+        return True
 
-    backup_folders = get_backup_folders(location)
-    backup_per_date = get_sorted_list(location, backup_folders)
 
-    duplicates_amount = clear_duplicate_files(backup_folders, location, backup_per_date)
-    clear_old_backups(backup_per_date, required_free_space, location)
+def source_size(directories: list[BackupDirectory]) -> int:
+    """Size of the files that go into a full backup, only the metadata is read"""
+    return changed_size(directories, {})
 
-    log.info(f"There are a total of {duplicates_amount} duplicate files found, all of them were removed")
 
+def compression_ratio(location: Path, incremental: bool = False) -> float:
+    """
+    Size of the recent backups of the same kind relative to the files they were made from, the highest one is used.
+    Without incremental backups yet the full backups are used, without any history the backup is assumed to be as large as its files.
+    """
+    backups = [backup for backup in catalog.list_backups(location) if backup.source_size]
+    same_kind = [backup for backup in backups if backup.incremental == incremental] or [backup for backup in backups if not backup.incremental]
+    return max((backup.size / backup.source_size for backup in same_kind[-RECENT_BACKUPS:]), default=1.0)  # type: ignore
 
-def check_and_clear(location: Path, min_free_gb: int, name: str):
-    space_left = psutil.disk_usage(str(location)).free / (1024 ** 3)
 
-    log.info(f"{name} free space: {space_left:.2f} GB")
+def space_locations(cfg: Config) -> list[tuple[Path, float, str]]:
+    """Every backup location with the free space it keeps and its name"""
+    space = SpacePolicy.parse(cfg.backup_space)
+    locations = [(cfg.backup_local_path, space.local, "Local Backup"), (cfg.backup_hdd_path, space.hdd, "HDD Backup")]
+    return [(Path(location), min_free_gb, name) for location, min_free_gb, name in locations if location]
 
-    if space_left < min_free_gb:
-        log.info(f"Less than {min_free_gb} GB left on {name}, clearing backup's...")
-        required_free_space = min_free_gb - space_left  # in GB
-        clear_backups(location, required_free_space)
-    else:
-        log.info(f"More than {min_free_gb} GB left on {name}, no need to clear backups.")
+
+def ensure_space(cfg: Config, size: int, incremental: bool = False) -> list[Path]:
+    """
+    Make room for the next backup on every location before it is written, with the size of the files it stores.
+    Archives are estimated with the compression ratio of the recent backups of the same kind, snapshots only write new
+    chunks so they are estimated at the size of the changed files. Only the space that is missing is freed with the
+    retention policy. Returns the locations that have enough space now.
+    """
+    space = SpacePolicy.parse(cfg.backup_space)
+    workers = cfg.backup_workers or os.cpu_count() or 1
+    policy = RetentionPolicy.parse(cfg.backup_retention)
+    locations = space_locations(cfg)
+    for location, _, _ in locations:
+        location.mkdir(parents=True, exist_ok=True)
+
+    # Locations on the same disk both get a copy of the backup from that disk
+    devices = [location.stat().st_dev for location, _, _ in locations]
+
+    enough_space: list[Path] = []
+    for (location, min_free_gb, name), device in zip(locations, devices):
+        catalog.reconcile(location)
+        ratio = 1.0 if cfg.backup_repository else compression_ratio(location, incremental)
+        estimate = size * ratio * space.margin * devices.count(device) / (1024 ** 3)
+        log.info(f"Next backup on {name} is estimated at {estimate:.2f} GB")
+
+        if check_and_clear(location, min_free_gb + estimate, name, workers, policy):
+            enough_space.append(location)
+        else:
+            log.error(f"Not enough space on {name} for the next backup")
+    return enough_space
 
 
 def main(cfg: Config):
-    if cfg.backup_local_path:
-        check_and_clear(Path(cfg.backup_local_path), 30, "Local Backup")
-    else:
-        log.info("Not checking local backup folder, since it doesn't exist")
-    if cfg.backup_hdd_path:
-        check_and_clear(Path(cfg.backup_hdd_path), 50, "HDD Backup")
-    else:
-        log.info("Not checking hdd backup folder, since it doesn't exist")
+    workers = cfg.backup_workers or os.cpu_count() or 1
+    policy = RetentionPolicy.parse(cfg.backup_retention)
+    for location, min_free_gb, name in space_locations(cfg):
+        check_and_clear(location, min_free_gb, name, workers, policy)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Remove old backups with the retention policy from the config")
+    parser.add_argument("location", type=Path, help="backup location, eg. the local or hdd backup folder")
+    parser.add_argument("--free", type=float, required=True, help="space to free in GB")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be removed")
+    args = parser.parse_args()
+
+    cfg = Config.load()
+    clear_backups(args.location, args.free, cfg.backup_workers or os.cpu_count() or 1, RetentionPolicy.parse(cfg.backup_retention), args.dry_run)
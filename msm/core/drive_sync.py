@@ -0,0 +1,112 @@
+import json
+import datetime
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+from msm.config.load_config import Config
+from msm.core.catalog import CatalogEntry, reconcile, list_backups, backup_date
+from msm.core.upload import UploadSettings, rclone, upload_file
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+# Every backup that is confirmed to be on the drive, stored on the drive itself next to the backups
+MANIFEST_FILE = "backup/manifest.json"
+
+
+def drive_remote(cfg: Config, backup_path: Path) -> str:
+    """Place of a backup on the drive, by the date and name of the backup itself"""
+    date = backup_date(backup_path.parent.name, backup_path.name) or datetime.datetime.now()
+    return f"{cfg.backup_drive_name}{date:backup/%y-%m-%d}/{backup_path.name}"
+
+
+def load_manifest(cfg: Config) -> dict[str, Any]:
+    """The manifest on the drive, empty if there is none yet"""
+    try:
+        return json.loads(rclone("cat", f"{cfg.backup_drive_name}{MANIFEST_FILE}"))
+    except subprocess.CalledProcessError:
+        return {"backups": {}}
+
+
+def save_manifest(cfg: Config, manifest: dict[str, Any]):
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        rclone("copyto", f.name, f"{cfg.backup_drive_name}{MANIFEST_FILE}")
+
+
+def manifest_entry(remote: str, size: int) -> dict[str, Any]:
+    return {"remote": remote, "size": size, "uploaded": datetime.datetime.now().isoformat(timespec="seconds")}
+
+
+def record_streamed_backup(cfg: Config, backup_path: Path, remote: str):
+    """Add a backup that was verified after a streaming upload to the manifest, so the drive backup doesn't check it again"""
+    try:
+        manifest = load_manifest(cfg)
+        manifest["backups"][f"{backup_path.parent.name}/{backup_path.name}"] = manifest_entry(remote, backup_path.stat().st_size)
+        save_manifest(cfg, manifest)
+    except (subprocess.CalledProcessError, OSError) as e:
+        # The drive backup finds the backup on the drive and adds it then
+        log.warning(f"Could not add {backup_path.name} to the drive manifest: {e}")
+
+
+def backups_to_sync(backups: list[CatalogEntry], days: int, now: datetime.datetime) -> list[CatalogEntry]:
+    """
+    The newest backup of every day in the last days, like the drive backup always uploaded.
+    An incremental backup is useless on its own, so its chain back to the full backup is added too.
+    """
+    newest: dict[datetime.date, int] = {}
+    for index, backup in enumerate(backups):
+        if (now - backup.timestamp).days < days:
+            newest[backup.timestamp.date()] = index
+
+    selected: set[int] = set()
+    for index in newest.values():
+        selected.add(index)
+        while backups[index].incremental and index > 0:
+            index -= 1
+            selected.add(index)
+    return [backups[index] for index in sorted(selected)]
+
+
+def sync_drive(cfg: Config) -> int:
+    """
+    Upload every backup of the last days that is not in the manifest on the drive yet, under its own date.
+    The manifest is only updated after an upload is verified, so a failed upload is tried again next time.
+    Returns the amount of backups that are still missing.
+    """
+    settings = UploadSettings.parse(cfg.backup_upload)
+    location = cfg.backup_local_path
+    if not location:
+        raise ValueError("Local backup is not defined")
+
+    reconcile(location)
+    manifest = load_manifest(cfg)
+    missing = [backup for backup in backups_to_sync(list_backups(location), settings.catch_up_days, datetime.datetime.now()) if backup.id not in manifest["backups"]]
+    if not missing:
+        log.info("Every backup is already on the drive")
+        return 0
+    log.info(f"Uploading {len(missing)} backups that are not on the drive yet: {', '.join(backup.id for backup in missing)}")
+
+    lock = threading.Lock()
+
+    def upload(backup: CatalogEntry) -> bool:
+        remote = drive_remote(cfg, backup.path)
+        if not upload_file(cfg, backup.path, remote):
+            return False
+        with lock:
+            manifest["backups"][backup.id] = manifest_entry(remote, backup.size)
+            save_manifest(cfg, manifest)
+        return True
+
+    # Oldest first, so an interrupted sync leaves as many complete chains as possible
+    with ThreadPoolExecutor(max_workers=settings.parallel) as pool:
+        failed = sum(not uploaded for uploaded in pool.map(upload, missing))
+
+    if failed:
+        log.error(f"{failed} of {len(missing)} backups could not be uploaded, they are tried again with the next drive backup")
+    return failed
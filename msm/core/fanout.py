@@ -0,0 +1,312 @@
+import io
+import os
+import errno
+import fcntl
+import queue
+import threading
+from time import monotonic
+from pathlib import Path
+from typing import Iterable, Optional, Protocol
+from msm.core.throttle import limit_io
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+# ioctl to clone a file on filesystems with reflinks (btrfs, xfs)
+FICLONE = 0x40049409
+# Written ranges are merged up to this size before a mirror copies them
+MAX_RANGE = 8 * 1024 * 1024
+# Errors that mean the kernel can't do this copy, so the next method is tried
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+def partial_path(path: Path) -> Path:
+    """Files are written under this name and only renamed once they are complete"""
+    return path.with_name(path.name + ".partial")
+
+
+class Mirror(threading.Thread):
+    """
+    Copies the ranges written to the primary file to another destination.
+    Data is read back from the primary file, which is still in the page cache,
+    so a slow drive never holds up the primary write and nothing is kept in memory.
+    """
+
+    def __init__(self, source: Path, destination: Path, reflink: bool):
+        super().__init__(daemon=True)
+        self.source = source
+        self.destination = destination
+        self.reflink = reflink
+        self.ranges: queue.Queue[Optional[tuple[int, int]]] = queue.Queue()
+        self.copied = 0
+        self.duration = 0.0
+        self.error: Optional[BaseException] = None
+        self.size = 0
+        self._copy_file_range = hasattr(os, "copy_file_range")
+        self._sendfile = True
+        self._finished = False
+        self.method = ""
+
+    def run(self):
+        t_beginning = monotonic()
+        try:
+            src_fd = os.open(self.source, os.O_RDONLY)
+            dst_fd = os.open(partial_path(self.destination), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                while (copy := self.ranges.get()) is not None:
+                    self.copy_range(src_fd, dst_fd, *copy)
+                self._finished = True
+
+                # Same filesystem, so the finished file is cloned instead of streamed
+                if self.reflink:
+                    self.clone(src_fd, dst_fd)
+
+                os.ftruncate(dst_fd, self.size)
+            finally:
+                os.close(src_fd)
+                os.close(dst_fd)
+        except BaseException as e:
+            self.error = e
+            # Keep draining, so the writer never blocks on a failed destination
+            while not self._finished and self.ranges.get() is not None:
+                pass
+        self.duration = monotonic() - t_beginning
+
+    def clone(self, src_fd: int, dst_fd: int):
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            self.copied = self.size
+            self.method = "reflink"
+        except OSError as e:
+            if e.errno not in UNSUPPORTED and e.errno != errno.ENOTTY:
+                raise
+            self.copy_range(src_fd, dst_fd, 0, self.size)
+
+    def copy_range(self, src_fd: int, dst_fd: int, offset: int, length: int):
+        """Copy a range in the kernel if possible, falls back to a normal read and write"""
+        end = offset + length
+        while offset < end:
+            amount = self._copy_chunk(src_fd, dst_fd, offset, end - offset)
+            if amount == 0:
+                raise OSError(f"Unexpected end of {self.source} at {offset}")
+            offset += amount
+            self.copied += amount
+
+    def _copy_chunk(self, src_fd: int, dst_fd: int, offset: int, length: int) -> int:
+        if self._copy_file_range:
+            try:
+                self.method = "copy_file_range"
+                return os.copy_file_range(src_fd, dst_fd, length, offset, offset)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                self._copy_file_range = False
+
+        if self._sendfile:
+            try:
+                self.method = "sendfile"
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                return os.sendfile(dst_fd, src_fd, offset, length)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                self._sendfile = False
+
+        self.method = "read and write"
+        data = os.pread(src_fd, min(length, MAX_RANGE), offset)
+        return os.pwrite(dst_fd, data, offset)
+
+
+class Stream(Protocol):
+    """Destination that only takes data in order, like the stdin of an upload"""
+    name: str
+
+    def write(self, data: bytes) -> int: ...
+    def close(self): ...
+    def abort(self): ...
+
+
+class StreamMirror(threading.Thread):
+    """
+    Sends the primary file in order to a stream while it is written. Like Mirror the data is read back
+    from the primary file, so a slow upload never holds up the primary write.
+    """
+
+    def __init__(self, source: Path, stream: Stream):
+        super().__init__(daemon=True)
+        self.source = source
+        self.stream = stream
+        self.ranges: queue.Queue[Optional[tuple[int, int]]] = queue.Queue()
+        self.copied = 0
+        self.duration = 0.0
+        self.error: Optional[BaseException] = None
+        self.success = True
+
+    def run(self):
+        t_beginning = monotonic()
+        finished = False
+        try:
+            src_fd = os.open(self.source, os.O_RDONLY)
+            try:
+                while (copy := self.ranges.get()) is not None:
+                    offset, length = copy
+                    while length > 0:
+                        data = os.pread(src_fd, min(length, MAX_RANGE), offset)
+                        if not data:
+                            raise OSError(f"Unexpected end of {self.source} at {offset}")
+                        self.stream.write(data)
+                        offset += len(data)
+                        length -= len(data)
+                        self.copied += len(data)
+                finished = True
+            finally:
+                os.close(src_fd)
+
+            # Closing the stream completes it, so a failed archive is aborted instead
+            if self.success:
+                self.stream.close()
+            else:
+                self.stream.abort()
+        except BaseException as e:
+            self.error = e
+            self.stream.abort()
+            while not finished and self.ranges.get() is not None:
+                pass
+        self.duration = monotonic() - t_beginning
+
+
+class FanOutFile:
+    """
+    Seekable file that writes to a primary destination and mirrors every write to the other destinations.
+    Every file is written under a .partial name and renamed when the file is closed without errors.
+    With streams the file can only be appended to, so the data is final once written and can be sent right away.
+    """
+
+    def __init__(self, primary: Path, mirrors: Iterable[Path] = (), streams: Iterable[Stream] = ()):
+        self.primary = primary
+        self.position = 0
+        self.size = 0
+        self._range: Optional[tuple[int, int]] = None
+        self._t_beginning = monotonic()
+
+        primary.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(partial_path(primary), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        primary_device = os.fstat(self._fd).st_dev
+
+        self.mirrors: list[Mirror] = []
+        for mirror in mirrors:
+            mirror.parent.mkdir(parents=True, exist_ok=True)
+            reflink = os.stat(mirror.parent).st_dev == primary_device
+            self.mirrors.append(Mirror(partial_path(primary), mirror, reflink))
+
+        self.streams = [StreamMirror(partial_path(primary), stream) for stream in streams]
+
+        for mirror in [*self.mirrors, *self.streams]:
+            mirror.start()
+
+    def write(self, data: bytes) -> int:
+        limit_io(len(data))
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += os.pwrite(self._fd, view[written:], self.position + written)
+
+        self._add_range(self.position, written)
+        self.position += written
+        self.size = max(self.size, self.position)
+        return written
+
+    def _add_range(self, offset: int, length: int):
+        """Merge ranges that follow each other, so mirrors copy big blocks"""
+        if self._range and self._range[0] + self._range[1] == offset and self._range[1] < MAX_RANGE:
+            self._range = (self._range[0], self._range[1] + length)
+            return
+        self._flush_range()
+        self._range = (offset, length)
+
+    def _flush_range(self):
+        if self._range:
+            for mirror in self.mirrors:
+                if not mirror.reflink:
+                    mirror.ranges.put(self._range)
+            for stream in self.streams:
+                stream.ranges.put(self._range)
+            self._range = None
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        # Writers like ZipFile fall back to writing without seeking, eg. with data descriptors in a zip
+        if self.streams:
+            raise io.UnsupportedOperation("Cannot seek in a file that is streamed")
+        if whence == os.SEEK_SET:
+            self.position = offset
+        elif whence == os.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def seekable(self) -> bool:
+        return not self.streams
+
+    def writable(self) -> bool:
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self, success: bool = True) -> list[Path]:
+        """Finish every destination, returns the destinations that were written successfully"""
+        self._flush_range()
+        os.close(self._fd)
+        primary_duration = monotonic() - self._t_beginning
+
+        for mirror in self.mirrors:
+            mirror.size = self.size
+            mirror.ranges.put(None)
+        for stream in self.streams:
+            stream.success = success
+            stream.ranges.put(None)
+        for mirror in [*self.mirrors, *self.streams]:
+            mirror.join()
+
+        completed: list[Path] = []
+        if success:
+            os.replace(partial_path(self.primary), self.primary)
+            completed.append(self.primary)
+            log_throughput(self.primary, self.size, primary_duration)
+
+        for mirror in self.mirrors:
+            if success and mirror.error is None:
+                os.replace(partial_path(mirror.destination), mirror.destination)
+                completed.append(mirror.destination)
+                log_throughput(mirror.destination, mirror.copied, mirror.duration, mirror.method)
+            else:
+                if mirror.error is not None:
+                    log.error(f"Writing backup to {mirror.destination} failed: {mirror.error}")
+                if partial_path(mirror.destination).exists():
+                    os.remove(partial_path(mirror.destination))
+
+        for stream in self.streams:
+            if stream.error is not None:
+                log.error(f"Streaming backup to {stream.stream.name} failed: {stream.error}")
+
+        if not success and partial_path(self.primary).exists():
+            os.remove(partial_path(self.primary))
+
+        return completed
+
+    def __enter__(self) -> "FanOutFile":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):  # type: ignore
+        self.completed = self.close(success=exc_type is None)
+
+
+def log_throughput(path: Path, size: int, duration: float, method: str = ""):
+    speed = size / (1024 ** 2) / duration if duration > 0 else 0
+    method = f" via {method}" if method else ""
+    log.info(f"Wrote {size / (1024 ** 2):.1f} MB to {path} in {duration:.1f} seconds ({speed:.1f} MB/s){method}")
@@ -0,0 +1,130 @@
+import os
+import shutil
+import dataclasses
+from time import sleep, monotonic
+from pathlib import Path
+from msm.config.load_config import Config, BackupDirectory
+from msm.core.archive import walk_backup_directories, CHUNK_SIZE
+from msm.core.throttle import copy_file
+from msm.services.server_console import send_command, read_console, output_after
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+READY_MESSAGE = "Files are now ready to be copied"
+QUERY_TIMEOUT = 60
+
+
+def get_worlds_path(cfg: Config) -> Path:
+    """The files from 'save query' are relative to the worlds folder of the server"""
+    if cfg.mc_worlds:
+        return Path(cfg.mc_worlds)
+
+    for backup_directory in cfg.get_backup_directories():
+        directory = Path(backup_directory.path)
+        if directory.name == "worlds":
+            return directory
+        if (directory / "worlds").is_dir():
+            return directory / "worlds"
+
+    raise ValueError("Cannot find the worlds folder in the backup directories, add it as 'worlds' under 'mc'")
+
+
+def parse_file_list(line: str) -> dict[str, int]:
+    """Parse the 'save query' file list, eg. 'Bedrock level/db/000005.ldb:1234, Bedrock level/level.dat:2530'"""
+    files: dict[str, int] = {}
+    for entry in line.split(", "):
+        path, _, length = entry.strip().rpartition(":")
+        if path and length.isdigit():
+            files[path] = int(length)
+    return files
+
+
+def query_files(cfg: Config) -> dict[str, int]:
+    """Ask the server which files to copy until the save is ready, returns every file with its length"""
+    t_beginning = monotonic()
+
+    while monotonic() - t_beginning < QUERY_TIMEOUT:
+        send_command(cfg, "save query")
+        sleep(1)
+
+        output = output_after(read_console(cfg), "save query")
+        for index, line in enumerate(output[:-1]):
+            if READY_MESSAGE in line:
+                return parse_file_list(output[index + 1])
+
+    raise TimeoutError(f"Server did not finish saving within {QUERY_TIMEOUT} seconds")
+
+
+def copy_truncated(source: Path, destination: Path, length: int):
+    """Copy only the first bytes of a file, the server may still append to it after the save"""
+    with open(source, "rb") as fsrc, open(destination, "wb") as fdst:
+        remaining = length
+        while remaining > 0 and (chunk := fsrc.read(min(CHUNK_SIZE, remaining))):
+            fdst.write(chunk)
+            remaining -= len(chunk)
+    shutil.copystat(source, destination)
+
+
+def stage_held_files(cfg: Config, staging: Path, held_files: dict[str, int]):
+    """
+    Copy only the files 'save query' reported, cut to the reported length. This runs while saves are held,
+    so the backup directories aren't walked and the copy isn't throttled, a held server can't save until it is done.
+    """
+    worlds_path = get_worlds_path(cfg)
+    roots = [(directory, os.path.realpath(directory.path)) for directory in cfg.get_backup_directories()]
+
+    for name, length in held_files.items():
+        path = worlds_path / name
+        real_path = os.path.realpath(path)
+        # A world is in the archive under every backup directory that contains it, with its rules
+        for directory, root in roots:
+            if not real_path.startswith(root + os.sep):
+                continue
+            relative_path = Path(os.path.relpath(real_path, root)).as_posix()
+            if directory.excluded(relative_path) or not directory.included(relative_path):
+                continue
+            destination = staging / directory.name / relative_path
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            copy_truncated(path, destination, length)
+
+
+def stage_directories(cfg: Config, staging: Path, held_files: dict[str, int]) -> list[BackupDirectory]:
+    """
+    Copy the rest of the backup directories into the staging folder, after saves are resumed.
+    Worlds that were held by the server are skipped, they only get the files copied by stage_held_files.
+    Returns the staged directories, they have the same names and policies as the backup directories.
+    """
+    worlds_path = get_worlds_path(cfg)
+    held_worlds = {os.path.realpath(worlds_path / name.split("/")[0]) for name in held_files}
+
+    for path, arcname in walk_backup_directories(cfg.backup_directories or [], skip=[staging]):
+        destination = staging / arcname
+        if path.is_dir():
+            destination.mkdir(parents=True, exist_ok=True)
+            continue
+
+        real_path = os.path.realpath(path)
+        if not any(real_path.startswith(world + os.sep) for world in held_worlds):
+            copy_file(path, destination)
+
+    return [dataclasses.replace(directory, path=str(staging / directory.name)) for directory in cfg.get_backup_directories()]
+
+
+def stage_hot_backup(cfg: Config, staging: Path) -> list[BackupDirectory]:
+    """Make a consistent copy of the backup directories while the server keeps running"""
+    t_beginning = monotonic()
+    send_command(cfg, "save hold")
+
+    try:
+        held_files = query_files(cfg)
+        log.info(f"Server is holding saves, copying {len(held_files)} world files")
+        stage_held_files(cfg, staging, held_files)
+    finally:
+        # Always resume, a server that stays on hold never saves the world again
+        send_command(cfg, "save resume")
+
+    log.info(f"Saves were held for {monotonic() - t_beginning:.1f} seconds")
+    # Everything outside the held worlds can be copied at the throttled rate, the server saves again meanwhile
+    return stage_directories(cfg, staging, held_files)
@@ -0,0 +1,203 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Any, Callable, Optional
+from msm.config.load_config import Config, BackupDirectory
+from msm.core.archive import walk_backup_directories, changed_size, write_entries, archive_name, read_member, extract_archive, DEFAULT_FORMAT, CHUNK_SIZE
+from msm.core.fanout import Stream
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+# Location of the backup info inside every archive made in incremental mode
+BACKUP_INFO = ".bsm/backup.json"
+STATE_FILE = "backup_manifest.json"
+DEFAULT_FULL_EVERY = 7
+
+Manifest = dict[str, dict[str, Any]]
+
+
+def hash_file(path: Path) -> str:
+    """Hash the content of a file"""
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def state_path(cfg: Config) -> Path:
+    return Path(os.path.join(cfg.path_base, STATE_FILE))  # type: ignore
+
+
+def load_state(cfg: Config) -> Optional[dict[str, Any]]:
+    """Load the manifest of the last backup, returns None if there never was one"""
+    path = state_path(cfg)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+
+def save_state(cfg: Config, state: dict[str, Any]):
+    """Save the manifest only once the backup is stored, so a failed backup never becomes a parent"""
+    path = state_path(cfg)
+    temp_path = path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(state))
+    os.replace(temp_path, path)
+
+
+def build_manifest(cfg: Config, directories: list[BackupDirectory], previous: Manifest) -> tuple[Manifest, list[tuple[Path, str]], list[tuple[Path, str]]]:
+    """
+    Walk the backup directories and compare every file with the previous manifest.
+    Files with the same size and mtime are trusted to be unchanged, others are hashed.
+    Returns the new manifest, every entry and the entries that were added or changed.
+    """
+    manifest: Manifest = {}
+    entries: list[tuple[Path, str]] = []
+    changed: list[tuple[Path, str]] = []
+
+    for path, arcname in walk_backup_directories(directories, skip=[state_path(cfg)]):
+        entries.append((path, arcname))
+        if path.is_dir():
+            continue
+
+        stat = path.stat()
+        old = previous.get(arcname)
+
+        if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime_ns:
+            manifest[arcname] = old
+            continue
+
+        file_hash = hash_file(path)
+        manifest[arcname] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": file_hash}
+
+        # A file that was only touched doesn't have to be stored again
+        if not old or old["hash"] != file_hash:
+            changed.append((path, arcname))
+
+    return manifest, entries, changed
+
+
+def starts_chain(cfg: Config, state: Optional[dict[str, Any]], locations: list[Path]) -> bool:
+    """
+    If the next backup is a full backup. The same archive goes to every location, so a new chain is started
+    when the parent is missing in any of them, eg. a location that was left out of the last backup for lack of space.
+    """
+    if state is None or state["chain"] + 1 >= (cfg.backup_full_every or DEFAULT_FULL_EVERY):
+        return True
+    # The parent can be gone, eg. removed as a duplicate or by hand, a chain on top of it could never be restored
+    for location in locations:
+        if not (location / state["last"]).exists():
+            log.warning(f"The previous backup {state['last']} is missing in {location}, starting a new chain")
+            return True
+    return False
+
+
+def incremental_size(cfg: Config, locations: list[Path], directories: list[BackupDirectory], skipped: list[BackupDirectory]) -> tuple[int, bool]:
+    """Size of the files the next backup to the locations will store and if it is a full backup, only the metadata is read"""
+    state = load_state(cfg)
+    if starts_chain(cfg, state, locations):
+        return changed_size(directories + skipped, {}, skip=[state_path(cfg)]), True
+    return changed_size(directories, state["manifest"], skip=[state_path(cfg)]), False  # type: ignore
+
+
+def generate_incremental_archive(cfg: Config, backup_name: str, folder_name: str, backup_folders: list[Path], directories: list[BackupDirectory], skipped: list[BackupDirectory], workers: int = 1, open_stream: Optional[Callable[[str], Stream]] = None) -> tuple[Path, dict[str, Any], list[BackupDirectory]]:
+    """
+    Generate a full or incremental archive, depending on the length of the current chain.
+    A full backup contains every directory, incremental backups only the ones that are due.
+    The archive is written to every backup folder in one pass, and to the stream open_stream gives for its file name.
+    Returns the path of the archive, the state that must be saved once the backup is stored and the directories it contains.
+    """
+    state = load_state(cfg)
+    full_every = cfg.backup_full_every or DEFAULT_FULL_EVERY
+
+    full = starts_chain(cfg, state, [folder.parent for folder in backup_folders])
+    previous: Manifest = {} if state is None else state["manifest"]
+
+    if full:
+        directories = directories + skipped
+        skipped = []
+
+    manifest, entries, changed = build_manifest(cfg, directories, previous)
+
+    # Files of skipped directories stay as they were, otherwise they would be marked as deleted
+    skipped_names = {directory.name for directory in skipped}
+    for arcname, entry in previous.items():
+        if arcname.split("/", 1)[0] in skipped_names:
+            manifest[arcname] = entry
+    deleted = sorted(set(previous) - set(manifest))
+
+    if full:
+        backup_type = "full"
+        parent = None
+        chain = 0
+    else:
+        backup_type = "incremental"
+        parent = state["last"]  # type: ignore
+        chain = state["chain"] + 1  # type: ignore
+        entries = changed
+        backup_name += "_incr"
+
+    format = cfg.backup_format or DEFAULT_FORMAT
+    file_name = archive_name(backup_name, format)
+    info = {"type": backup_type, "parent": parent, "deleted": [] if full else deleted, "manifest": manifest}
+
+    backup_path = backup_folders[0] / file_name
+    mirrors = [folder / file_name for folder in backup_folders[1:]]
+    compression_modes = {directory.name: directory.compression for directory in directories}
+    streams = [open_stream(file_name)] if open_stream else []
+    write_entries(entries, backup_path, workers=workers, extra_files={BACKUP_INFO: json.dumps(info).encode()}, mirrors=mirrors, format=format, level=cfg.backup_level, compression_modes=compression_modes, streams=streams)
+
+    if full:
+        log.info(f"Full backup with {len(manifest)} files, starting a new chain")
+    else:
+        log.info(f"Incremental backup {chain}/{full_every - 1}: {len(changed)} changed and {len(deleted)} deleted files")
+
+    new_state = {"last": f"{folder_name}/{file_name}", "chain": chain, "manifest": manifest}
+    return backup_path, new_state, directories
+
+
+def read_backup_info(archive: Path) -> Optional[dict[str, Any]]:
+    """Read the backup info of an archive, archives made without incremental mode have none"""
+    info = read_member(archive, BACKUP_INFO)
+    return json.loads(info) if info is not None else None
+
+
+def get_chain(archive: Path) -> list[Path]:
+    """Get every archive needed to restore this archive, starting with the full backup"""
+    # Parents are saved relative to the backup location, eg. "2025-03-24/backup_20-00-00.zip"
+    backup_location = archive.parent.parent
+    chain = [archive]
+
+    info = read_backup_info(archive)
+    while info and info["parent"]:
+        parent = backup_location / info["parent"]
+        if not parent.exists():
+            raise FileNotFoundError(f"Backup chain of {archive} is broken, missing: {parent}")
+        chain.append(parent)
+        info = read_backup_info(parent)
+
+    return list(reversed(chain))
+
+
+def restore_chain(archive: Path, destination: Path, workers: int = 1, prefixes: Optional[list[str]] = None):
+    """Rebuild the backup directories as they were at the time of the archive, with prefixes only the folders inside them"""
+    if destination.exists() and any(destination.iterdir()):
+        raise ValueError(f"Cannot restore into {destination}, since it is not empty")
+
+    chain = get_chain(archive)
+    log.info(f"Restoring {archive.name} from a chain of {len(chain)} backups")
+
+    for backup in chain:
+        info = read_backup_info(backup) or {}
+
+        for name in info.get("deleted", []):
+            deleted_path = destination / name
+            if deleted_path.is_file():
+                os.remove(deleted_path)
+
+        extract_archive(backup, destination, skip=[BACKUP_INFO], workers=workers, prefixes=prefixes)
+
+        log.info(f"Applied {backup.name}")
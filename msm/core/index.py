@@ -0,0 +1,139 @@
+import shutil
+import argparse
+import sqlite3
+import zipfile
+from time import monotonic
+from contextlib import closing
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+from msm.config.load_config import Config
+from msm.core.archive import get_format, open_tar_zst
+from msm.core.catalog import connect, reconcile
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+
+def read_entries(archive: Path) -> Iterator[tuple[str, int, Optional[int]]]:
+    """Every file in an archive with its size and crc, a zip only needs its central directory to be read"""
+    if get_format(archive) == "tar.zst":
+        # A tar has no table of contents and no crc, so the whole stream is read
+        with open_tar_zst(archive) as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, member.size, None
+        return
+
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            if not info.is_dir():
+                yield info.filename, info.file_size, info.CRC
+
+
+def add_archive(connection: sqlite3.Connection, archive_id: str, archive: Path):
+    """Add the files of a backup in the catalog to the index, the files of an earlier version are replaced"""
+    with connection:
+        connection.execute("DELETE FROM entries WHERE backup_id = ?", (archive_id,))
+        connection.executemany(
+            "INSERT INTO entries VALUES (?, ?, ?, ?)",
+            ((path, archive_id, size, crc) for path, size, crc in read_entries(archive))
+        )
+        connection.execute("UPDATE backups SET indexed = 1 WHERE id = ?", (archive_id,))
+
+
+def update_index(location: str | Path) -> tuple[int, int]:
+    """
+    Bring the catalog up to date with the backups on disk and index the files of new backups.
+    Returns the amount of added and removed backups.
+    """
+    added, removed = reconcile(location)
+
+    with closing(connect(location)) as connection:
+        for archive_id, path in connection.execute("SELECT id, path FROM backups WHERE indexed = 0").fetchall():
+            try:
+                add_archive(connection, archive_id, Path(path))
+            except Exception as e:
+                log.error(f"Could not index {path}: {e}")
+
+    return added, removed
+
+
+def find_versions(location: str | Path, path: str, prefix: bool = False) -> list[tuple[str, str, int, Optional[int]]]:
+    """
+    Every backup that contains a file, newest first, as (backup id, path, size, crc).
+    With prefix every file inside a folder is found, eg. 'worlds/Bedrock level/'
+    """
+    with closing(connect(location)) as connection:
+        if prefix:
+            # A range on the primary key instead of LIKE, so the lookup stays an index search
+            query = "SELECT backup_id, path, size, crc FROM entries WHERE path >= ? AND path < ? ORDER BY backup_id DESC, path"
+            return connection.execute(query, (path, path + "\U0010ffff")).fetchall()
+        query = "SELECT backup_id, path, size, crc FROM entries WHERE path = ? ORDER BY backup_id DESC"
+        return connection.execute(query, (path,)).fetchall()
+
+
+def extract_entry(archive: Path, name: str, destination: Path) -> Path:
+    """Extract a single file of a backup, a zip only reads that file"""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+
+    if get_format(archive) == "tar.zst":
+        with open_tar_zst(archive) as tar:
+            for member in tar:
+                if member.name == name:
+                    with tar.extractfile(member) as fsrc, open(destination, "wb") as fdst:  # type: ignore
+                        shutil.copyfileobj(fsrc, fdst)
+                    return destination
+        raise FileNotFoundError(f"{name} is not in {archive}")
+
+    with zipfile.ZipFile(archive) as zf, zf.open(name) as fsrc, open(destination, "wb") as fdst:
+        shutil.copyfileobj(fsrc, fdst)
+    return destination
+
+
+def index_locations(cfg: Config) -> list[Path]:
+    return [Path(location) for location in [cfg.backup_local_path, cfg.backup_hdd_path] if location]
+
+
+def main(arguments: Optional[Iterable[str]] = None):
+    parser = argparse.ArgumentParser(description="Search the content of every backup")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("update", help="index new backups and forget removed ones")
+    versions = commands.add_parser("versions", help="list the backups that contain a file")
+    versions.add_argument("path", help="path inside the backups, eg. 'worlds/Bedrock level/level.dat'")
+    versions.add_argument("--prefix", action="store_true", help="find every file inside this folder")
+    extract = commands.add_parser("extract", help="extract a single file from a backup")
+    extract.add_argument("backup", help="backup id, eg. '2025-03-24/backup_20-00-00.zip'")
+    extract.add_argument("path", help="path inside the backup")
+    extract.add_argument("destination", type=Path)
+    args = parser.parse_args(arguments)
+
+    cfg = Config.load()
+    locations = index_locations(cfg)
+
+    if args.command == "update":
+        for location in locations:
+            t_beginning = monotonic()
+            added, removed = update_index(location)
+            log.info(f"Index of {location}: {added} backups added, {removed} removed in {monotonic() - t_beginning:.1f} seconds")
+
+    elif args.command == "versions":
+        for location in locations:
+            t_beginning = monotonic()
+            found = find_versions(location, args.path, args.prefix)
+            for archive_id, path, size, crc in found:
+                print(f"{location / archive_id}  {path}  {size} bytes  crc {crc:08x}" if crc is not None else f"{location / archive_id}  {path}  {size} bytes")
+            log.info(f"Found {len(found)} versions in {location} in {(monotonic() - t_beginning) * 1000:.1f} ms")
+
+    elif args.command == "extract":
+        for location in locations:
+            if (location / args.backup).is_file():
+                extract_entry(location / args.backup, args.path, args.destination)
+                log.info(f"Extracted {args.path} to {args.destination}")
+                return
+        raise FileNotFoundError(f"Cannot find the backup '{args.backup}'")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
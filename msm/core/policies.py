@@ -0,0 +1,63 @@
+import os
+import json
+import datetime
+from pathlib import Path
+from typing import Optional
+from msm.config.load_config import Config, BackupDirectory
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+SCHEDULE_FILE = "backup_schedule.json"
+
+
+def schedule_path(cfg: Config) -> Path:
+    return Path(os.path.join(cfg.path_base, SCHEDULE_FILE))  # type: ignore
+
+
+def load_schedule(cfg: Config) -> dict[str, str]:
+    """Load when every backup directory was last backed up, keyed by its name"""
+    path = schedule_path(cfg)
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def is_due(directory: BackupDirectory, last: Optional[str], now: datetime.datetime) -> bool:
+    """Daily directories are backed up once per calendar day, weekly ones once per ISO week"""
+    if directory.frequency == "shutdown" or last is None:
+        return True
+
+    last_date = datetime.datetime.fromisoformat(last).date()
+    if directory.frequency == "daily":
+        return last_date != now.date()
+    return last_date.isocalendar()[:2] != now.date().isocalendar()[:2]
+
+
+def due_directories(cfg: Config, now: Optional[datetime.datetime] = None) -> tuple[list[BackupDirectory], list[BackupDirectory]]:
+    """Split the backup directories into the ones that should be backed up now and the ones that can be skipped"""
+    now = now or datetime.datetime.now()
+    schedule = load_schedule(cfg)
+
+    due: list[BackupDirectory] = []
+    skipped: list[BackupDirectory] = []
+    for directory in cfg.get_backup_directories():
+        (due if is_due(directory, schedule.get(directory.name), now) else skipped).append(directory)
+
+    if skipped:
+        log.info(f"Skipping {', '.join(directory.name for directory in skipped)}, not due until the next day or week")
+    return due, skipped
+
+
+def mark_backed_up(cfg: Config, directories: list[BackupDirectory], now: Optional[datetime.datetime] = None):
+    """Save the time of the backup, only once it is stored, so a failed backup is tried again"""
+    now = now or datetime.datetime.now()
+    schedule = load_schedule(cfg)
+    for directory in directories:
+        schedule[directory.name] = now.isoformat(timespec="seconds")
+
+    path = schedule_path(cfg)
+    temp_path = path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(schedule))
+    os.replace(temp_path, path)
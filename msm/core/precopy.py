@@ -0,0 +1,103 @@
+import os
+import json
+import shutil
+import dataclasses
+from time import monotonic
+from pathlib import Path
+from typing import Any
+from msm.config.load_config import Config, BackupDirectory
+from msm.core.archive import walk_backup_directories
+from msm.core.throttle import copy_file
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+STAGING_DIR = "backup_staging"
+# Size and mtime of every source file when it was staged, saved next to the staged directories
+STAGING_STATE = "staging.json"
+
+
+def staging_path(cfg: Config) -> Path:
+    return Path(os.path.join(cfg.path_base, STAGING_DIR))  # type: ignore
+
+
+def load_staging_state(staging: Path) -> dict[str, Any]:
+    path = staging / STAGING_STATE
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def sync_staging(cfg: Config, staging: Path) -> tuple[int, int]:
+    """
+    Bring the staged copy of the backup directories up to date, only files whose size or mtime
+    changed since they were staged are copied. Returns the amount of copied and removed files.
+    """
+    state = load_staging_state(staging)
+    new_state: dict[str, Any] = {}
+    folders: set[str] = set()
+    copied = 0
+
+    for path, arcname in walk_backup_directories(cfg.get_backup_directories(), skip=[staging]):
+        destination = staging / arcname
+        if path.is_dir():
+            destination.mkdir(parents=True, exist_ok=True)
+            folders.add(arcname)
+            continue
+
+        # The stat is taken before copying, so a file that changes during the copy is copied again next time
+        stat = path.stat()
+        old = state.get(arcname)
+        if not old or old != [stat.st_size, stat.st_mtime_ns] or not destination.exists():
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            copy_file(path, destination)
+            copied += 1
+        new_state[arcname] = [stat.st_size, stat.st_mtime_ns]
+
+    # Remove what was deleted from the server since it was staged
+    removed = 0
+    for dirpath, _, filenames in sorted(os.walk(staging), reverse=True):
+        relative_dir = Path(dirpath).relative_to(staging).as_posix()
+        if relative_dir == ".":
+            continue
+        for name in filenames:
+            if f"{relative_dir}/{name}" not in new_state:
+                os.remove(os.path.join(dirpath, name))
+                removed += 1
+        if relative_dir not in folders and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+    temp_path = staging / (STAGING_STATE + ".tmp")
+    temp_path.write_text(json.dumps(new_state))
+    os.replace(temp_path, staging / STAGING_STATE)
+    return copied, removed
+
+
+def precopy(cfg: Config):
+    """First phase, stage the backup directories while the server is still running and empty"""
+    t_beginning = monotonic()
+    staging = staging_path(cfg)
+    staging.mkdir(parents=True, exist_ok=True)
+
+    copied, removed = sync_staging(cfg, staging)
+    log.info(f"Pre-copied {copied} files and removed {removed} files in {monotonic() - t_beginning:.1f} seconds")
+
+
+def final_pass(cfg: Config) -> list[BackupDirectory]:
+    """
+    Second phase, run once the server is stopped. Only the files that changed since the pre-copy are copied.
+    Returns the staged directories, they have the same names and policies as the backup directories.
+    """
+    t_beginning = monotonic()
+    staging = staging_path(cfg)
+    staging.mkdir(parents=True, exist_ok=True)
+
+    copied, removed = sync_staging(cfg, staging)
+    log.info(f"Final pass copied {copied} changed files and removed {removed} files in {monotonic() - t_beginning:.1f} seconds")
+
+    return [dataclasses.replace(directory, path=str(staging / directory.name)) for directory in cfg.get_backup_directories()]
+
+
+def remove_staging(cfg: Config):
+    shutil.rmtree(staging_path(cfg), ignore_errors=True)
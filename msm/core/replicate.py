@@ -0,0 +1,108 @@
+import os
+import json
+import datetime
+import tempfile
+from time import monotonic
+from pathlib import Path
+from typing import Optional
+from msm.config.load_config import Config, BackupDirectory
+from msm.core.fanout import log_throughput
+from msm.core.incremental import Manifest, build_manifest
+from msm.core.throttle import rclone_flags
+from msm.core.upload import UploadSettings, rclone
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+REPLICA_STATE = "replica_manifest.json"
+# The newest version of every file is in current, older versions are moved to a folder of the date they were replaced
+CURRENT_DIR = "replica/current"
+VERSIONS_DIR = "replica/versions"
+
+
+def replica_state_path(cfg: Config) -> Path:
+    return Path(os.path.join(cfg.path_base, REPLICA_STATE))  # type: ignore
+
+
+def load_replica_manifest(cfg: Config) -> Manifest:
+    """Hashes of the files on the drive, so the changes are found without listing the drive"""
+    path = replica_state_path(cfg)
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def save_replica_manifest(cfg: Config, manifest: Manifest):
+    path = replica_state_path(cfg)
+    temp_path = path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(manifest))
+    os.replace(temp_path, path)
+
+
+def transfer_files(settings: UploadSettings, command: str, source: str, destination: str, files: list[str], versions: Optional[str] = None):
+    """Copy or move the given files, with versions a file that is replaced on the drive is moved there first"""
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as files_from:
+        files_from.write("\n".join(files) + "\n")
+        files_from.flush()
+        rclone(
+            command, source, destination,
+            # World names are chosen by players, --files-from would drop names starting with # or ; and trim spaces
+            "--files-from-raw", files_from.name,
+            # Only the listed files are checked on the drive, the drive itself is never listed
+            "--no-traverse",
+            *(["--backup-dir", versions] if versions else []),
+            "--transfers", str(settings.streams),
+            "--retries", str(settings.retries),
+            "--retries-sleep", f"{settings.backoff:g}s",
+            *rclone_flags(),
+            *settings.flags,
+        )
+
+
+def replicate_directory(cfg: Config, settings: UploadSettings, directory: BackupDirectory, changed: list[str], deleted: list[str], stamp: str):
+    current = f"{cfg.backup_drive_name}{CURRENT_DIR}/{directory.name}"
+    versions = f"{cfg.backup_drive_name}{VERSIONS_DIR}/{stamp}/{directory.name}"
+
+    if changed:
+        transfer_files(settings, "copy", directory.path, current, changed, versions)
+    if deleted:
+        # Deleted files are kept as a version too, the drive moves them without uploading anything
+        transfer_files(settings, "move", current, versions, deleted)
+
+
+def replicate(cfg: Config) -> tuple[int, int]:
+    """
+    Mirror the backup directories to the drive file by file, only files that changed since the last run are uploaded.
+    Replaced and deleted files are kept in a folder of the date, so every earlier day can be put back together.
+    The manifest is only saved once every change is on the drive. Returns the amount of changed and deleted files.
+    """
+    settings = UploadSettings.parse(cfg.backup_upload)
+    directories = cfg.get_backup_directories()
+    previous = load_replica_manifest(cfg)
+
+    manifest, _, changed = build_manifest(cfg, directories, previous)
+    # Files of directories that are no longer backed up stay on the drive
+    names = {directory.name for directory in directories}
+    deleted = [arcname for arcname in previous if arcname not in manifest and arcname.split("/", 1)[0] in names]
+    if not changed and not deleted:
+        log.info("The drive replica is up to date")
+        return 0, 0
+
+    size = sum(manifest[arcname]["size"] for _, arcname in changed)
+    log.info(f"Replicating {len(changed)} changed files ({size / (1024 ** 2):.1f} MB) and {len(deleted)} deleted files to the drive")
+
+    t_beginning = monotonic()
+    stamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    for directory in directories:
+        prefix = f"{directory.name}/"
+        replicate_directory(
+            cfg, settings, directory,
+            [arcname.removeprefix(prefix) for _, arcname in changed if arcname.startswith(prefix)],
+            [arcname.removeprefix(prefix) for arcname in deleted if arcname.startswith(prefix)],
+            stamp,
+        )
+
+    log_throughput(Path(f"{cfg.backup_drive_name}{CURRENT_DIR}"), size, monotonic() - t_beginning, "rclone")
+    save_replica_manifest(cfg, manifest)
+    return len(changed), len(deleted)
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Iterable, Optional
+from msm.config.load_config import BackupDirectory
+from msm.core.archive import walk_backup_directories, changed_size, in_prefixes, SAMPLE_SIZE, STORE_RATIO
+from msm.core.throttle import ThrottledReader
+from msm.core.catalog import backup_date
+from msm.core.retention import Backup, RetentionPolicy, plan_retention
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+REPOSITORY_DIR = "repository"
+# LevelDB tables are written once and never changed, so fixed size chunks deduplicate them well
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Every chunk starts with one byte telling how it is stored
+COMPRESSED = b"z"
+STORED = b"s"
+
+Snapshot = dict[str, Any]
+
+
+def chunk_path(repository: Path, chunk_hash: str) -> Path:
+    return repository / "chunks" / chunk_hash[:2] / chunk_hash
+
+
+def snapshot_path(repository: Path, snapshot_id: str) -> Path:
+    return repository / "snapshots" / f"{snapshot_id}.json"
+
+
+def list_snapshots(repository: Path) -> list[str]:
+    """Get the id of every snapshot, oldest first"""
+    snapshot_folder = repository / "snapshots"
+    if not snapshot_folder.exists():
+        return []
+    return sorted(entry.name.removesuffix(".json") for entry in os.scandir(snapshot_folder) if entry.name.endswith(".json"))
+
+
+def load_snapshot(repository: Path, snapshot_id: str) -> Snapshot:
+    return json.loads(snapshot_path(repository, snapshot_id).read_text())
+
+
+def snapshot_date(snapshot_id: str) -> datetime:
+    """Snapshot ids are the date and name of the backup, eg. '2025-03-24_backup_20-00-00'"""
+    return backup_date(snapshot_id[:10], snapshot_id[11:]) or datetime.strptime(snapshot_id[:10], "%Y-%m-%d")
+
+
+def write_atomic(path: Path, data: bytes):
+    """Write a file under a temporary name first, so a crash never leaves a half written file behind"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def store_chunk(repository: Path, data: bytes) -> tuple[str, int]:
+    """Store a chunk under its hash if it isn't stored yet, returns the hash and the amount of bytes written"""
+    chunk_hash = hashlib.blake2b(data, digest_size=20).hexdigest()
+    path = chunk_path(repository, chunk_hash)
+
+    if path.exists():
+        return chunk_hash, 0
+
+    # Chunks of already compressed files are stored as is, a quick sample shows which ones
+    sample = data[:SAMPLE_SIZE]
+    if len(zlib.compress(sample, 1)) >= len(sample) * STORE_RATIO:
+        stored = STORED + data
+    else:
+        compressed = zlib.compress(data)
+        stored = COMPRESSED + compressed if len(compressed) < len(data) else STORED + data
+    write_atomic(path, stored)
+    return chunk_hash, len(stored)
+
+
+def read_chunk(repository: Path, chunk_hash: str) -> bytes:
+    stored = chunk_path(repository, chunk_hash).read_bytes()
+    if stored[:1] == COMPRESSED:
+        return zlib.decompress(stored[1:])
+    return stored[1:]
+
+
+def store_file(repository: Path, path: Path) -> tuple[list[str], int]:
+    """Split a file into chunks and store the new ones, returns the chunk hashes and the amount of bytes written"""
+    chunks: list[str] = []
+    written = 0
+    with ThrottledReader(path) as f:
+        while data := f.read(CHUNK_SIZE):
+            chunk_hash, chunk_written = store_chunk(repository, data)
+            chunks.append(chunk_hash)
+            written += chunk_written
+    return chunks, written
+
+
+def create_snapshot(repository: Path, directories: Iterable[str | Path | BackupDirectory], snapshot_id: str, workers: int = 1, keep: Iterable[str] = ()) -> Snapshot:
+    """
+    Store the backup directories as a snapshot, only chunks that aren't in the repository yet are written.
+    Files with the same size and mtime as in the previous snapshot reuse its chunk list without being read.
+    The top level folders in keep are copied from the previous snapshot without reading them.
+    """
+    snapshots = list_snapshots(repository)
+    previous_snapshot = load_snapshot(repository, snapshots[-1]) if snapshots else {"folders": [], "files": {}}
+    previous: dict[str, Any] = previous_snapshot["files"]
+
+    keep = set(keep)
+    folders: list[str] = [folder for folder in previous_snapshot["folders"] if folder.split("/", 1)[0] in keep]
+    files: dict[str, Any] = {arcname: entry for arcname, entry in previous.items() if arcname.split("/", 1)[0] in keep}
+    to_store: list[tuple[Path, str]] = []
+
+    for path, arcname in walk_backup_directories(directories, skip=[repository]):
+        if path.is_dir():
+            folders.append(arcname)
+            continue
+
+        stat = path.stat()
+        old = previous.get(arcname)
+        if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime_ns:
+            files[arcname] = old
+        else:
+            files[arcname] = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+            to_store.append((path, arcname))
+
+    # Chunks are stored under their hash, so files can safely be stored at the same time
+    written = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for (path, arcname), (chunks, file_written) in zip(to_store, pool.map(lambda entry: store_file(repository, entry[0]), to_store)):
+            files[arcname]["chunks"] = chunks
+            written += file_written
+
+    snapshot: Snapshot = {"id": snapshot_id, "folders": folders, "files": files}
+    write_atomic(snapshot_path(repository, snapshot_id), json.dumps(snapshot).encode())
+
+    log.info(f"Snapshot {snapshot_id}: {len(files)} files, {len(to_store)} read, {written / (1024 ** 2):.1f} MB of new chunks")
+    return snapshot
+
+
+def snapshot_size(repository: Path, directories: Iterable[str | Path | BackupDirectory]) -> int:
+    """Most the next snapshot can write, the size of the files that changed since the last snapshot"""
+    snapshots = list_snapshots(repository) if repository.exists() else []
+    previous = load_snapshot(repository, snapshots[-1])["files"] if snapshots else {}
+    return changed_size(directories, previous, skip=[repository])
+
+
+def sync_repository(source: Path, destination: Path, snapshot_id: str) -> int:
+    """Copy a snapshot and the chunks it needs to another repository, returns the amount of chunks copied"""
+    snapshot = load_snapshot(source, snapshot_id)
+    copied = 0
+
+    for chunk_hash in {chunk for file in snapshot["files"].values() for chunk in file["chunks"]}:
+        destination_chunk = chunk_path(destination, chunk_hash)
+        if not destination_chunk.exists():
+            write_atomic(destination_chunk, chunk_path(source, chunk_hash).read_bytes())
+            copied += 1
+
+    # The snapshot is copied last, so it never points to missing chunks
+    destination_snapshot = snapshot_path(destination, snapshot_id)
+    destination_snapshot.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy(snapshot_path(source, snapshot_id), destination_snapshot)
+
+    log.info(f"Copied snapshot {snapshot_id} to {destination} with {copied} new chunks")
+    return copied
+
+
+def restore_snapshot(repository: Path, snapshot_id: str, destination: Path, workers: int = 1, prefixes: Optional[list[str]] = None):
+    """Rebuild the backup directories from a snapshot, with prefixes only the folders inside them"""
+    snapshot = load_snapshot(repository, snapshot_id)
+    files = {arcname: file for arcname, file in snapshot["files"].items() if in_prefixes(arcname, prefixes)}
+
+    # Folders are made up front, so files can be restored at the same time
+    for folder in snapshot["folders"]:
+        if in_prefixes(folder, prefixes):
+            (destination / folder).mkdir(parents=True, exist_ok=True)
+    for arcname in files:
+        (destination / arcname).parent.mkdir(parents=True, exist_ok=True)
+
+    def restore_file(arcname: str):
+        path = destination / arcname
+        with open(path, "wb") as f:
+            for chunk_hash in files[arcname]["chunks"]:
+                f.write(read_chunk(repository, chunk_hash))
+        os.utime(path, ns=(files[arcname]["mtime"], files[arcname]["mtime"]))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(restore_file, files))
+
+    log.info(f"Restored snapshot {snapshot_id} to {destination}")
+
+
+def count_references(repository: Path, snapshots: Iterable[str]) -> dict[str, int]:
+    """Count how many snapshots use every chunk"""
+    references: dict[str, int] = {}
+    for snapshot_id in snapshots:
+        chunks = {chunk for file in load_snapshot(repository, snapshot_id)["files"].values() for chunk in file["chunks"]}
+        for chunk_hash in chunks:
+            references[chunk_hash] = references.get(chunk_hash, 0) + 1
+    return references
+
+
+def remove_snapshot(repository: Path, snapshot_id: str, references: dict[str, int], dry_run: bool = False) -> int:
+    """
+    Remove a snapshot and every chunk no other snapshot uses, returns the amount of bytes freed.
+    With dry_run nothing is removed, only the references are counted down.
+    """
+    snapshot = load_snapshot(repository, snapshot_id)
+    freed = 0
+
+    if not dry_run:
+        os.remove(snapshot_path(repository, snapshot_id))
+
+    for chunk_hash in {chunk for file in snapshot["files"].values() for chunk in file["chunks"]}:
+        references[chunk_hash] -= 1
+        if references[chunk_hash] == 0:
+            del references[chunk_hash]
+            path = chunk_path(repository, chunk_hash)
+            freed += path.stat().st_size
+            if not dry_run:
+                os.remove(path)
+
+    if not dry_run:
+        log.info(f"Removed snapshot {snapshot_id}, freed {freed / (1024 ** 3):.2f} GB")
+    return freed
+
+
+def collect_garbage(repository: Path) -> int:
+    """Remove every chunk that is not used by any snapshot, eg. after an interrupted backup"""
+    references = count_references(repository, list_snapshots(repository))
+    freed = 0
+
+    chunk_folder = repository / "chunks"
+    if not chunk_folder.exists():
+        return 0
+
+    for prefix in os.scandir(chunk_folder):
+        for entry in os.scandir(prefix.path):
+            if entry.name.endswith(".tmp") or entry.name not in references:
+                freed += entry.stat().st_size
+                os.remove(entry.path)
+
+    log.info(f"Garbage collection freed {freed / (1024 ** 3):.2f} GB")
+    return freed
+
+
+def clear_old_snapshots(repository: Path, required_free_space: float, policy: RetentionPolicy = RetentionPolicy(), dry_run: bool = False) -> float:
+    """
+    Same retention as for archives: remove the oldest snapshots the retention policy doesn't keep until enough space
+    is freed. Chunks are shared, so the space a snapshot frees is only known once the snapshots before it are removed.
+    Returns the freed space in GB.
+    """
+    snapshots = list_snapshots(repository)
+    references = count_references(repository, snapshots)
+    freed_space = 0.0
+
+    # Snapshots don't depend on each other, every snapshot the policy doesn't keep can be removed on its own
+    backups = [Backup(snapshot_path(repository, snapshot_id), snapshot_date(snapshot_id), 0, False) for snapshot_id in snapshots]
+    plan, _ = plan_retention(backups, policy, sys.maxsize)
+
+    for backup in plan:
+        if freed_space >= required_free_space:
+            break
+        snapshot_id = backup.path.name.removesuffix(".json")
+        freed = remove_snapshot(repository, snapshot_id, references, dry_run) / (1024 ** 3)
+        freed_space += freed
+        if dry_run:
+            log.info(f"Would remove snapshot {snapshot_id} ({freed:.2f} GB)")
+
+    if freed_space < required_free_space:
+        log.error("No more old snapshots to remove, but not enough space freed.")
+
+    log.info(f"Total {'space that would be freed' if dry_run else 'freed space'} in repository: {freed_space:.2f} GB")
+    return freed_space
+
+
+def get_repository(location: str | Path) -> Optional[Path]:
+    """Get the repository in a backup location if there is one"""
+    repository = Path(location) / REPOSITORY_DIR
+    return repository if repository.exists() else None
@@ -0,0 +1,139 @@
+import os
+import shutil
+from time import monotonic
+from pathlib import Path
+from typing import Optional
+from msm.config.load_config import Config, BackupDirectory
+from msm.core.backup import get_latest_backup, get_workers
+from msm.core.hot_backup import get_worlds_path
+from msm.core.incremental import restore_chain
+from msm.core.repository import REPOSITORY_DIR, list_snapshots, restore_snapshot
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+RESTORE_DIR = "restore_staging"
+
+
+def find_backup(cfg: Config, name: Optional[str] = None) -> Path | str:
+    """
+    Find the backup to restore, returns the path of an archive or the id of a repository snapshot.
+    Without a name the latest backup is used, otherwise a path, a name like '2025-03-24/backup_20-00-00.zip' or a snapshot id.
+    """
+    locations = [Path(location) for location in [cfg.backup_local_path, cfg.backup_hdd_path] if location]
+
+    if name is None:
+        if cfg.backup_repository:
+            for location in locations:
+                snapshots = list_snapshots(location / REPOSITORY_DIR)
+                if snapshots:
+                    return snapshots[-1]
+        latest_backup = get_latest_backup(cfg)
+        if latest_backup:
+            return Path(os.path.realpath(latest_backup))
+        raise FileNotFoundError("There is no latest backup to restore")
+
+    if Path(name).is_file():
+        return Path(name)
+
+    for location in locations:
+        if (location / name).is_file():
+            return location / name
+        matches = sorted(location.glob(f"*/{name}"))
+        if matches:
+            return matches[-1]
+        if name in list_snapshots(location / REPOSITORY_DIR):
+            return name
+
+    raise FileNotFoundError(f"Cannot find a backup named '{name}'")
+
+
+def restore_targets(cfg: Config, world: Optional[str] = None) -> dict[str, tuple[Path, BackupDirectory]]:
+    """Get the folders to restore by their name inside the backup, with their location and backup directory"""
+    directories = cfg.get_backup_directories()
+    if world is None:
+        return {directory.name: (Path(directory.path), directory) for directory in directories}
+
+    worlds_path = get_worlds_path(cfg)
+    for directory in directories:
+        relative_path = os.path.relpath(os.path.realpath(worlds_path), os.path.realpath(directory.path))
+        if relative_path == "." or not relative_path.startswith(".."):
+            prefix = directory.name if relative_path == "." else f"{directory.name}/{Path(relative_path).as_posix()}"
+            return {f"{prefix}/{world}": (worlds_path / world, directory)}
+
+    raise ValueError(f"The worlds folder {worlds_path} is not in any backup directory")
+
+
+def swap_into_place(staged: Path, destination: Path):
+    """Replace a folder by its restored version with renames, so it is never half restored"""
+    restore_path = destination.with_name(f".{destination.name}.restore")
+    old_path = destination.with_name(f".{destination.name}.old")
+    for leftover in [restore_path, old_path]:
+        shutil.rmtree(leftover, ignore_errors=True)
+
+    # A rename when the staging folder is on the same drive, a copy otherwise
+    shutil.move(staged, restore_path)
+    if destination.exists():
+        os.rename(destination, old_path)
+    os.rename(restore_path, destination)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def holds_program_files(cfg: Config, destination: Path) -> bool:
+    """If the base path or a backup location is inside a folder, those files are not in the backup"""
+    folder = os.path.realpath(destination)
+    paths = [os.path.realpath(path) for path in [cfg.path_base, cfg.backup_local_path, cfg.backup_hdd_path] if path]
+    return any(path == folder or path.startswith(folder + os.sep) for path in paths)
+
+
+def merge_into_place(staged: Path, destination: Path):
+    """
+    Move every restored file over the current one. Used for directories with include or exclude rules or with the
+    base path or a backup location in them, since files that were never backed up would be lost when the whole folder is swapped.
+    """
+    for dirpath, _, filenames in os.walk(staged):
+        target_dir = destination / Path(dirpath).relative_to(staged)
+        target_dir.mkdir(parents=True, exist_ok=True)
+        for name in filenames:
+            shutil.move(os.path.join(dirpath, name), target_dir / name)
+
+
+def restore_backup(cfg: Config, name: Optional[str] = None, world: Optional[str] = None):
+    """Restore a backup, or only a single world, the server has to be stopped"""
+    t_beginning = monotonic()
+    backup = find_backup(cfg, name)
+    targets = restore_targets(cfg, world)
+    workers = get_workers(cfg)
+    log.info(f"Restoring {', '.join(targets)} from {backup}")
+
+    staging = Path(os.path.join(cfg.path_base, RESTORE_DIR))  # type: ignore
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+
+    try:
+        # Everything is extracted before anything is replaced, a failed extraction leaves the server untouched
+        if isinstance(backup, Path):
+            restore_chain(backup, staging, workers=workers, prefixes=list(targets))
+        else:
+            locations = [Path(location) for location in [cfg.backup_local_path, cfg.backup_hdd_path] if location]
+            repository = next(location / REPOSITORY_DIR for location in locations if backup in list_snapshots(location / REPOSITORY_DIR))
+            restore_snapshot(repository, backup, staging, workers=workers, prefixes=list(targets))
+        log.info(f"Extracted the backup in {monotonic() - t_beginning:.1f} seconds")
+
+        for prefix, (destination, directory) in targets.items():
+            staged = staging / prefix
+            if not staged.exists():
+                log.warning(f"{prefix} is not in the backup, keeping the current version")
+                continue
+
+            # Swapping a folder with the config, backups and catalog in it would delete them
+            if directory.include or directory.exclude or holds_program_files(cfg, destination):
+                merge_into_place(staged, destination)
+            else:
+                swap_into_place(staged, destination)
+            log.info(f"Restored {destination}")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    log.info(f"Restore finished in {monotonic() - t_beginning:.1f} seconds")
@@ -0,0 +1,114 @@
+import heapq
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Optional
+from msm.core.catalog import reconcile, list_backups
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    """
+    Grandfather-father-son retention, the newest backup of the last N hours, days, weeks and months is kept.
+    In the config under 'retention', eg. {hourly: 24, daily: 7, weekly: 4, monthly: 12}
+    """
+    hourly: int = 24
+    daily: int = 7
+    weekly: int = 4
+    monthly: int = 12
+
+    @classmethod
+    def parse(cls, entry: Optional[dict[str, Any]]) -> "RetentionPolicy":
+        policy = cls(**(entry or {}))
+        if min(policy.hourly, policy.daily, policy.weekly, policy.monthly) < 0:
+            raise ValueError("Retention amounts can't be negative")
+        return policy
+
+
+@dataclass(frozen=True)
+class Backup:
+    path: Path
+    date: datetime
+    size: int
+    incremental: bool
+
+
+# Period of a backup for every kind of retention
+PERIODS: dict[str, Callable[[datetime], tuple[int, ...]]] = {
+    "hourly": lambda date: (date.year, date.month, date.day, date.hour),
+    "daily": lambda date: (date.year, date.month, date.day),
+    "weekly": lambda date: tuple(date.isocalendar()[:2]),
+    "monthly": lambda date: (date.year, date.month),
+}
+
+
+def read_inventory(location: Path) -> list[Backup]:
+    """Every backup in a location from the catalog, oldest first"""
+    reconcile(location)
+    return [Backup(entry.path, entry.timestamp, entry.size, entry.incremental) for entry in list_backups(location)]
+
+
+def protected_backups(backups: list[Backup], policy: RetentionPolicy) -> set[Path]:
+    """The backups the policy keeps, an incremental backup also keeps every backup before it in its chain"""
+    protected: set[Path] = set()
+    if backups:
+        protected.add(backups[-1].path)
+
+    for kind, period in PERIODS.items():
+        amount = getattr(policy, kind)
+        seen: set[tuple[int, ...]] = set()
+        # Newest first, so the newest backup of every period is kept
+        for backup in reversed(backups):
+            if len(seen) >= amount:
+                break
+            key = period(backup.date)
+            if key not in seen:
+                seen.add(key)
+                protected.add(backup.path)
+
+    # Every incremental backup needs the full backup and the incremental backups before it
+    chain: list[Backup] = []
+    for backup in backups:
+        if not backup.incremental:
+            chain = []
+        chain.append(backup)
+        if backup.path in protected:
+            protected.update(link.path for link in chain)
+
+    return protected
+
+
+def plan_retention(backups: list[Backup], policy: RetentionPolicy, required_space: int) -> tuple[list[Backup], int]:
+    """
+    Build the whole deletion plan at once, the oldest backups the policy doesn't keep are removed first
+    until the required space in bytes is freed. Returns the backups to remove and the space they free.
+    """
+    protected = protected_backups(backups, policy)
+
+    # Backups that are not kept are removed per chain, removing a backup the next one depends on would break it.
+    # A chain that is kept can still lose the incremental backups after its last kept backup.
+    units: list[list[Backup]] = []
+    previous: Optional[Backup] = None
+    for backup in backups:
+        if backup.path not in protected:
+            if backup.incremental and units and units[-1][-1] is previous:
+                units[-1].append(backup)
+            else:
+                units.append([backup])
+        previous = backup
+
+    heap = [(unit[0].date, str(unit[0].path), index) for index, unit in enumerate(units)]
+    heapq.heapify(heap)
+
+    plan: list[Backup] = []
+    freed = 0
+    while heap and freed < required_space:
+        unit = units[heapq.heappop(heap)[-1]]
+        plan.extend(unit)
+        freed += sum(backup.size for backup in unit)
+
+    return plan, freed
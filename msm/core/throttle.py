@@ -0,0 +1,185 @@
+import os
+import shutil
+import threading
+import subprocess
+from time import monotonic, sleep
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+from msm.config.load_config import Config
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class Limits:
+    """
+    Limits of a backup or upload job, in the config under 'throttle' per state of the server:
+    {online: {nice: 19, ionice: idle, rate: 20}, empty: {nice: 10, ionice: "best-effort:7", rate: 100}}
+    The rate is in MB/s and limits both reading and writing.
+    """
+    nice: int = 0
+    ionice: Optional[str] = None
+    rate: Optional[float] = None
+
+    @classmethod
+    def parse(cls, entry: Optional[dict[str, Any]]) -> "Limits":
+        if not entry:
+            return cls()
+        limits = cls(nice=int(entry.get("nice", 0)), ionice=entry.get("ionice"), rate=entry.get("rate"))
+        if limits.ionice and limits.ionice.split(":")[0] not in IONICE_CLASSES:
+            raise ValueError(f"Unknown ionice class '{limits.ionice}', use one of: {', '.join(IONICE_CLASSES)}")
+        return limits
+
+
+class RateLimiter:
+    """Spreads the I/O of every throttled job over time, shared by all threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_time = monotonic()
+
+    def wait(self, amount: int, rate: float):
+        with self.lock:
+            now = monotonic()
+            # Time that was not used is not saved up, so there are no bursts after a pause
+            start = max(now, self.next_time)
+            self.next_time = start + amount / (rate * 1024 ** 2)
+        if start > now:
+            sleep(start - now)
+
+
+_limiter = RateLimiter()
+_state = "stopped"
+_jobs: list[Config] = []
+_jobs_lock = threading.Lock()
+
+
+def set_server_state(state: str):
+    """
+    Set to online, empty or stopped with every status check, the rate of running jobs follows the state.
+    Jobs only get full speed while the server is stopped.
+    """
+    global _state
+    _state = state
+
+
+def get_limits(cfg: Config, state: Optional[str] = None) -> Limits:
+    state = state or _state
+    if state == "stopped":
+        return Limits()
+    return Limits.parse((cfg.backup_throttle or {}).get(state))
+
+
+def apply_priority(limits: Limits):
+    """Set the CPU and I/O priority of the current thread, threads and processes started from it inherit them"""
+    thread_id = threading.get_native_id()
+
+    if limits.nice:
+        current = os.getpriority(os.PRIO_PROCESS, thread_id)
+        os.setpriority(os.PRIO_PROCESS, thread_id, max(current, limits.nice))
+
+    if limits.ionice:
+        ionice_class, _, level = limits.ionice.partition(":")
+        command = ["ionice", "-c", str(IONICE_CLASSES[ionice_class]), *(["-n", level] if level else []), "-p", str(thread_id)]
+        try:
+            subprocess.run(command, check=True, capture_output=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning(f"Could not set the I/O priority to {limits.ionice}: {e}")
+
+
+@contextmanager
+def throttled(cfg: Config) -> Iterator[Limits]:
+    """
+    Throttle the current thread with the limits of the current state of the server.
+    A nice value can't be lowered again, so only use this on threads that end with the job, see run_throttled.
+    """
+    limits = get_limits(cfg)
+    apply_priority(limits)
+    with _jobs_lock:
+        _jobs.append(cfg)
+    try:
+        yield limits
+    finally:
+        with _jobs_lock:
+            _jobs.remove(cfg)
+
+
+def run_throttled(cfg: Config, function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run a job on its own thread with the limits of the current state, so the calling thread keeps its priority"""
+    result: dict[str, Any] = {}
+
+    def run():
+        try:
+            with throttled(cfg):
+                result["value"] = function(*args, **kwargs)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, name="throttled job")
+    thread.start()
+    thread.join()
+
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+def current_rate() -> Optional[float]:
+    """The lowest rate of the running jobs, jobs can overlap, like a pre-copy and a hot backup"""
+    return min((limits.rate for limits in (get_limits(cfg) for cfg in list(_jobs)) if limits.rate), default=None)
+
+
+def limit_io(amount: int):
+    """Wait until the given amount of bytes may be read or written, returns right away without throttled jobs"""
+    if not _jobs:
+        return
+
+    rate = current_rate()
+    if rate:
+        _limiter.wait(amount, rate)
+
+
+class ThrottledReader:
+    """A file opened for reading, every read waits for the rate limit while a throttled job is running"""
+
+    def __init__(self, path: str | Path):
+        self.file = open(path, "rb")
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        limit_io(len(data))
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self) -> "ThrottledReader":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def copy_file(source: str | Path, destination: str | Path):
+    """Copy a file and its metadata, at the rate limit while a throttled job is running"""
+    if not _jobs:
+        shutil.copy2(source, destination)
+        return
+
+    with ThrottledReader(source) as fsrc, open(destination, "wb") as fdst:
+        while chunk := fsrc.read(CHUNK_SIZE):
+            fdst.write(chunk)
+    shutil.copystat(source, destination)
+
+
+def rclone_flags() -> list[str]:
+    """Bandwidth limit for rclone while a throttled job is running, rclone itself inherits the priorities"""
+    rate = current_rate()
+    return ["--bwlimit", f"{rate}M"] if rate else []
@@ -0,0 +1,239 @@
+import os
+import json
+import datetime
+import tempfile
+import threading
+import subprocess
+from time import monotonic, sleep
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+from msm.config.load_config import Config
+from msm.core.fanout import log_throughput
+from msm.core.throttle import rclone_flags
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+UPLOAD_STATE = "drive_upload.json"
+# Amount of uploads kept in the throughput history
+HISTORY_LENGTH = 50
+
+# Uploads can run in parallel, see drive_sync.py
+_state_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class UploadSettings:
+    """
+    Settings of the drive upload, in the config under 'upload': {streams: 4, chunk_size: 64M, retries: 5, backoff: 30}.
+    Extra rclone flags can be added under 'flags', eg. backend specific chunk sizes like ["--onedrive-chunk-size", "50M"].
+    With 'stream: true' the backup is uploaded while it is written, instead of with the drive backup.
+    The drive backup uploads the backups of the last 'catch_up_days' days that are missing, 'parallel' at a time.
+    With 'replicate: true' the drive backup mirrors the backup directories file by file instead, see replicate.py.
+    """
+    streams: int = 4
+    chunk_size: str = "64M"
+    retries: int = 5
+    backoff: float = 30
+    flags: tuple[str, ...] = ()
+    stream: bool = False
+    parallel: int = 2
+    catch_up_days: int = 7
+    replicate: bool = False
+
+    @classmethod
+    def parse(cls, entry: Optional[dict[str, Any]]) -> "UploadSettings":
+        settings = cls(**{**(entry or {}), "flags": tuple((entry or {}).get("flags") or ())})
+        if min(settings.streams, settings.retries, settings.parallel, settings.catch_up_days) < 1:
+            raise ValueError("The upload needs at least one stream, attempt, parallel upload and day to catch up")
+        return settings
+
+
+def state_path(cfg: Config) -> Path:
+    return Path(os.path.join(cfg.path_base, UPLOAD_STATE))  # type: ignore
+
+
+def load_upload_state(cfg: Config) -> dict[str, Any]:
+    """The last upload and the throughput of earlier uploads"""
+    path = state_path(cfg)
+    if not path.exists():
+        return {"history": []}
+    return json.loads(path.read_text())
+
+
+def save_upload_state(cfg: Config, state: dict[str, Any]):
+    path = state_path(cfg)
+    temporary = path.with_suffix(".tmp")
+    temporary.write_text(json.dumps(state, indent=2))
+    os.replace(temporary, path)
+
+
+def rclone(*arguments: str) -> str:
+    """Run rclone and return its output, a failed command raises CalledProcessError"""
+    return subprocess.run(["rclone", *arguments], capture_output=True, text=True, check=True).stdout
+
+
+def remote_file(remote: str) -> Optional[dict[str, Any]]:
+    """Size and hashes of a file on the drive, None if it doesn't exist"""
+    try:
+        return json.loads(rclone("lsjson", "--stat", "--hash", "--no-mimetype", remote))
+    except subprocess.CalledProcessError:
+        return None
+
+
+def local_hash(path: Path, hash_type: str) -> str:
+    """Hash a local file with rclone, so every hash type of every drive is supported, like OneDrive's quickxor"""
+    return rclone("hashsum", hash_type, str(path)).split()[0]
+
+
+def verify_upload(source: Path, remote: str) -> bool:
+    """Compare the uploaded file with the local one by a hash the drive supports, or by size if it supports none"""
+    info = remote_file(remote)
+    if not info or info.get("IsDir"):
+        return False
+    if info["Size"] != source.stat().st_size:
+        log.warning(f"Size of {remote} is {info['Size']} bytes instead of {source.stat().st_size}")
+        return False
+
+    for hash_type, remote_hash in (info.get("Hashes") or {}).items():
+        if not remote_hash:
+            continue
+        if local_hash(source, hash_type) != remote_hash:
+            log.warning(f"The {hash_type} hash of {remote} doesn't match the local backup")
+            return False
+        return True
+
+    log.info(f"The drive has no hash for {remote}, only the size is checked")
+    return True
+
+
+def upload_flags(settings: UploadSettings) -> list[str]:
+    """
+    Files larger than a chunk are uploaded in chunks on multiple streams, where the drive supports it.
+    Retries are handled here, so rclone only retries single requests.
+    """
+    return [
+        "--multi-thread-streams", str(settings.streams),
+        "--multi-thread-chunk-size", settings.chunk_size,
+        "--multi-thread-cutoff", settings.chunk_size,
+        "--checksum",
+        "--retries", "1",
+        *rclone_flags(),
+        *settings.flags,
+    ]
+
+
+def upload_file(cfg: Config, source: Path, remote: str) -> bool:
+    """
+    Upload a file to the drive and verify it, failed attempts are retried with exponential backoff.
+    A file that is already on the drive, eg. when an earlier upload finished but was not recorded, isn't uploaded again.
+    Returns if the file is on the drive now.
+    """
+    settings = UploadSettings.parse(cfg.backup_upload)
+    size = source.stat().st_size
+
+    with _state_lock:
+        state = load_upload_state(cfg)
+        last = state.get("last")
+        if last and last["source"] == str(source) and last["remote"] == remote and last["size"] == size and last["verified"]:
+            log.info(f"{source} is already uploaded to {remote}")
+            return True
+
+        state["last"] = {"source": str(source), "remote": remote, "size": size, "verified": False}
+        save_upload_state(cfg, state)
+
+    t_beginning = monotonic()
+    attempts = 0
+    verified = verify_upload(source, remote)
+    if verified:
+        log.info(f"{remote} is already on the drive, skipping the upload")
+
+    while not verified and attempts < settings.retries:
+        if attempts:
+            delay = settings.backoff * 2 ** (attempts - 1)
+            log.info(f"Retrying the upload in {delay:.0f} seconds")
+            sleep(delay)
+        attempts += 1
+
+        try:
+            rclone("copyto", *upload_flags(settings), str(source), remote)
+        except subprocess.CalledProcessError as e:
+            log.warning(f"Upload attempt {attempts} of {settings.retries} failed with code {e.returncode}: {e.stderr.strip()[-500:]}")
+            continue
+        verified = verify_upload(source, remote)
+
+    duration = monotonic() - t_beginning
+    if verified and attempts:
+        log_throughput(Path(remote), size, duration, f"rclone after {attempts} attempts" if attempts > 1 else "rclone")
+    record_upload(cfg, source, remote, verified, duration, attempts)
+
+    if not verified:
+        log.error(f"Upload of {source} to {remote} failed after {attempts} attempts")
+    return verified
+
+
+def record_upload(cfg: Config, source: Path, remote: str, verified: bool, duration: float, attempts: int):
+    """Save the result of the last upload, and its throughput if something was uploaded"""
+    size = source.stat().st_size
+    with _state_lock:
+        state = load_upload_state(cfg)
+        state["last"] = {"source": str(source), "remote": remote, "size": size, "verified": verified}
+        if verified and attempts:
+            state["history"] = [*state["history"], {
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "remote": remote,
+                "bytes": size,
+                "seconds": round(duration, 1),
+                "mb_per_s": round(size / (1024 ** 2) / duration, 2) if duration > 0 else 0,
+                "attempts": attempts,
+            }][-HISTORY_LENGTH:]
+        save_upload_state(cfg, state)
+
+
+class StreamUpload:
+    """
+    Upload a backup while it is written, the archive is piped into 'rclone rcat'. Used as a stream of FanOutFile,
+    so compressing, writing the local copy and uploading overlap and the upload ends shortly after the local copy.
+    """
+
+    def __init__(self, cfg: Config, remote: str):
+        settings = UploadSettings.parse(cfg.backup_upload)
+        self.cfg = cfg
+        self.name = remote
+        # rclone can log a lot while retrying, a file never fills up like a pipe would
+        self.errors = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(["rclone", "rcat", *rclone_flags(), *settings.flags, remote], stdin=subprocess.PIPE, stderr=self.errors)
+        self.t_beginning = monotonic()
+
+    def write(self, data: bytes) -> int:
+        return self.process.stdin.write(data)  # type: ignore
+
+    def close(self):
+        self.process.stdin.close()  # type: ignore
+
+    def abort(self):
+        # Without a clean end of the input, rclone doesn't store the partial file
+        self.process.kill()
+
+    def finish(self, source: Path) -> bool:
+        """
+        Wait for the upload and verify it against the local copy. A failed stream is only recorded, this runs between
+        stopping the server and shutting down, so the drive backup uploads the local copy with its retries instead.
+        Returns if the backup is on the drive now.
+        """
+        returncode = self.process.wait()
+        duration = monotonic() - self.t_beginning
+        self.errors.seek(0)
+        errors = self.errors.read().decode(errors="replace").strip()
+        self.errors.close()
+
+        if returncode == 0 and verify_upload(source, self.name):
+            log_throughput(Path(self.name), source.stat().st_size, duration, "rclone rcat")
+            record_upload(self.cfg, source, self.name, True, duration, 1)
+            return True
+
+        log.warning(f"Streaming upload to {self.name} failed with code {returncode}: {errors[-500:]}")
+        record_upload(self.cfg, source, self.name, False, duration, 1)
+        return False
@@ -0,0 +1,163 @@
+import os
+import json
+import zlib
+import tarfile
+import zipfile
+import threading
+from datetime import datetime
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, Optional
+from msm.config.load_config import Config
+from msm.core.archive import get_format, open_tar_zst, _zstandard, CHUNK_SIZE
+from msm.core.catalog import reconcile, list_backups, set_verification
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+# The result of a verification is saved next to the backup, eg. "backup_20-00-00.zip.verify.json"
+RESULT_SUFFIX = ".verify.json"
+# Only the first errors are saved, a truncated archive can have thousands
+MAX_ERRORS = 10
+READ_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, OSError, ValueError)
+
+
+def result_path(archive: Path) -> Path:
+    return archive.with_name(archive.name + RESULT_SUFFIX)
+
+
+def load_result(archive: Path) -> Optional[dict[str, Any]]:
+    """Load the last verification result of a backup, returns None if it was never verified"""
+    path = result_path(archive)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+
+def save_result(archive: Path, result: dict[str, Any]):
+    path = result_path(archive)
+    temp_path = path.with_name(path.name + ".tmp")
+    temp_path.write_text(json.dumps(result))
+    os.replace(temp_path, path)
+
+
+def _check_zip(archive: Path, workers: int) -> tuple[int, list[str]]:
+    """
+    Read every entry of a zip, which checks its CRC, without writing anything to disk.
+    Every thread gets its own handle to the archive, so the entries are decompressed in parallel.
+    """
+    with zipfile.ZipFile(archive) as zf:
+        infos = [info for info in zf.infolist() if not info.is_dir()]
+
+    local = threading.local()
+    handles: list[zipfile.ZipFile] = []
+    lock = threading.Lock()
+
+    def check(info: zipfile.ZipInfo) -> Optional[str]:
+        if not hasattr(local, "zf"):
+            local.zf = zipfile.ZipFile(archive)
+            with lock:
+                handles.append(local.zf)
+        try:
+            with local.zf.open(info) as f:
+                while f.read(CHUNK_SIZE):
+                    pass
+        except READ_ERRORS as e:
+            return f"{info.filename}: {e}"
+        return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            errors = [error for error in pool.map(check, infos) if error]
+    finally:
+        for handle in handles:
+            handle.close()
+
+    return len(infos), errors
+
+
+def _check_tar_zst(archive: Path) -> tuple[int, list[str]]:
+    """A zstd stream can only be read from the start, zstd checks the checksum of every frame while reading"""
+    files = 0
+    try:
+        with open_tar_zst(archive) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                f = tar.extractfile(member)
+                while f and f.read(CHUNK_SIZE):  # type: ignore
+                    pass
+                files += 1
+    except (tarfile.TarError, _zstandard().ZstdError) as e:
+        # The stream can't be read past an error, so only the first one is known
+        return files, [f"after {files} files: {e}"]
+    return files, []
+
+
+def verify_archive(archive: Path, workers: int = 1) -> dict[str, Any]:
+    """Check if every file in a backup archive can be read, the result is saved next to the backup"""
+    t_beginning = monotonic()
+
+    try:
+        if get_format(archive) == "tar.zst":
+            files, errors = _check_tar_zst(archive)
+        else:
+            files, errors = _check_zip(archive, workers)
+    except READ_ERRORS as e:
+        # The archive itself can't be opened, eg. a zip without a central directory
+        files, errors = 0, [str(e) or type(e).__name__]
+
+    result = {
+        "ok": not errors,
+        "files": files,
+        "errors": errors[:MAX_ERRORS],
+        "duration": round(monotonic() - t_beginning, 3),
+        "verified": datetime.now().isoformat(timespec="seconds"),
+    }
+    save_result(archive, result)
+    set_verification(archive, result["ok"], result["verified"])
+
+    if errors:
+        log.error(f"Backup {archive} is corrupt, {len(errors)} errors, first: {errors[0]}")
+    else:
+        log.info(f"Verified {files} files in {archive.name} in {result['duration']:.1f} seconds")
+    return result
+
+
+def find_archives(locations: Iterable[str | Path]) -> list[Path]:
+    """Every backup archive in the catalogs of the backup locations"""
+    archives: list[Path] = []
+    for location in locations:
+        reconcile(location)
+        archives.extend(backup.path for backup in list_backups(location))
+    return archives
+
+
+def main(paths: list[str], workers: Optional[int] = None) -> bool:
+    """Verify the given archives, or every backup of the local and hdd folder. Returns if all of them are fine"""
+    if paths:
+        archives = [Path(path) for path in paths]
+    else:
+        cfg = Config.load()
+        archives = find_archives(location for location in [cfg.backup_local_path, cfg.backup_hdd_path] if location)
+
+    results = [verify_archive(archive, workers or os.cpu_count() or 1) for archive in archives]
+    corrupt = sum(not result["ok"] for result in results)
+    log.info(f"Verified {len(results)} backups, {corrupt} corrupt")
+    return corrupt == 0
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Check if backup archives can be read, without extracting them")
+    parser.add_argument("archives", nargs="*", help="archives to verify, every backup of the local and hdd folder by default")
+    parser.add_argument("--workers", type=int, help="threads used for a zip, every core by default")
+    args = parser.parse_args()
+
+    sys.exit(0 if main(args.archives, args.workers) else 1)
@@ -0,0 +1,148 @@
+import os
+import socket
+import struct
+import selectors
+from time import monotonic, monotonic_ns
+from dataclasses import dataclass, replace
+from typing import Iterable, Optional
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+# RakNet unconnected ping and pong, the pong carries the status of a Bedrock server as a string
+UNCONNECTED_PING = 0x01
+UNCONNECTED_PONG = 0x1C
+MAGIC = bytes.fromhex("00ffff00fefefefefdfdfdfd12345678")
+PING = struct.Struct(">BQ16sQ")
+PONG = struct.Struct(">BQQ16sH")
+
+Target = tuple[str, int]
+
+
+@dataclass(frozen=True)
+class PingResponse:
+    """Status of a Bedrock server, latency is the round trip in milliseconds"""
+    players: int
+    max_players: int
+    version: str
+    protocol: int
+    motd: str
+    map: str
+    latency: float
+
+
+def parse_pong(data: bytes) -> tuple[int, PingResponse]:
+    """Parse a pong, returns the timestamp of the ping it answers and the status, the latency is filled in later"""
+    packet_id, timestamp, _, magic, length = PONG.unpack_from(data)
+    if packet_id != UNCONNECTED_PONG or magic != MAGIC:
+        raise ValueError("Not a RakNet unconnected pong")
+
+    # Eg. "MCPE;Dedicated Server;712;1.21.20;0;10;12345678901234567890;Bedrock level;Survival;1;19132;19133;"
+    fields = data[PONG.size:PONG.size + length].decode("utf-8", errors="replace").split(";")
+    if len(fields) < 6:
+        raise ValueError(f"Unexpected server status: {';'.join(fields)}")
+    status = PingResponse(
+        players=int(fields[4]),
+        max_players=int(fields[5]),
+        version=fields[3],
+        protocol=int(fields[2]),
+        motd=fields[1],
+        map=fields[7] if len(fields) > 7 else "",
+        latency=0.0,
+    )
+    return timestamp, status
+
+
+class BedrockPinger:
+    """
+    Pings Bedrock servers with RakNet unconnected pings over one socket per address family, kept open between polls.
+    Every ping gets its own timestamp, which the server sends back, so a late pong of an earlier poll is never
+    taken as the answer, and the round trip is measured from it.
+    """
+
+    def __init__(self, timeout: float = 3.0):
+        self.timeout = timeout
+        self.guid = int.from_bytes(os.urandom(8), "big")
+        self.selector = selectors.DefaultSelector()
+        self.sockets: dict[int, socket.socket] = {}
+        self.addresses: dict[Target, tuple[int, tuple]] = {}  # type: ignore
+        self.last_timestamp = 0
+
+    def _socket(self, family: int) -> socket.socket:
+        if family not in self.sockets:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+            self.sockets[family] = sock
+        return self.sockets[family]
+
+    def _resolve(self, target: Target) -> tuple[int, tuple]:  # type: ignore
+        """Targets are only resolved once, so a poll doesn't wait for DNS"""
+        if target not in self.addresses:
+            family, _, _, _, address = socket.getaddrinfo(target[0], target[1], type=socket.SOCK_DGRAM)[0]
+            self.addresses[target] = (family, address)
+        return self.addresses[target]
+
+    def _timestamp(self) -> int:
+        # Milliseconds like a game client sends, but unique for every ping
+        self.last_timestamp = max(self.last_timestamp + 1, monotonic_ns() // 1_000_000)
+        return self.last_timestamp
+
+    def ping_many(self, targets: Iterable[Target]) -> dict[Target, Optional[PingResponse]]:
+        """Ping every target at once and wait for all pongs, a target that doesn't answer in time gets None"""
+        pending: dict[tuple[tuple, int], tuple[Target, float]] = {}  # type: ignore
+        results: dict[Target, Optional[PingResponse]] = {}
+
+        for target in targets:
+            results[target] = None
+            try:
+                family, address = self._resolve(target)
+                timestamp = self._timestamp()
+                self._socket(family).sendto(PING.pack(UNCONNECTED_PING, timestamp, MAGIC, self.guid), address)
+                pending[(address[:2], timestamp)] = (target, monotonic())
+            except OSError as e:
+                log.error(f"Cannot ping {target[0]}:{target[1]}: {e}")
+
+        deadline = monotonic() + self.timeout
+        while pending and (remaining := deadline - monotonic()) > 0:
+            for key, _ in self.selector.select(remaining):
+                sock: socket.socket = key.fileobj  # type: ignore
+                while True:
+                    try:
+                        data, address = sock.recvfrom(2048)
+                    except BlockingIOError:
+                        break
+                    except OSError:
+                        # Eg. an ICMP port unreachable of a stopped server, the ping just times out
+                        break
+
+                    try:
+                        timestamp, status = parse_pong(data)
+                    except (ValueError, struct.error):
+                        continue
+                    match = pending.pop((address[:2], timestamp), None)
+                    if match:
+                        target, sent = match
+                        results[target] = replace(status, latency=(monotonic() - sent) * 1000)
+
+        return results
+
+    def ping(self, host: str, port: int = 19132) -> PingResponse:
+        status = self.ping_many([(host, port)])[(host, port)]
+        if status is None:
+            raise TimeoutError(f"No answer from {host}:{port} within {self.timeout} seconds")
+        return status
+
+    def close(self):
+        for sock in self.sockets.values():
+            self.selector.unregister(sock)
+            sock.close()
+        self.sockets.clear()
+        self.selector.close()
+
+    def __enter__(self) -> "BedrockPinger":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
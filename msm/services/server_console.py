@@ -0,0 +1,34 @@
+import subprocess
+from msm.config.load_config import Config
+import logging
+
+# Get logger
+log = logging.getLogger("bsm")
+
+
+def get_session(cfg: Config) -> str:
+    if not cfg.mc_session:
+        raise ValueError("The tmux session of the Minecraft server is not defined, add it as 'session' under 'mc'")
+    return cfg.mc_session
+
+
+def send_command(cfg: Config, command: str):
+    """Type a command into the console of the running server"""
+    subprocess.run(["tmux", "send-keys", "-t", get_session(cfg), command, "Enter"], check=True)
+
+
+def read_console(cfg: Config, lines: int = 500) -> list[str]:
+    """Get the last lines of the server console, wrapped lines are joined back together"""
+    output = subprocess.run(
+        ["tmux", "capture-pane", "-p", "-J", "-t", get_session(cfg), "-S", f"-{lines}"],
+        capture_output=True, text=True, check=True
+    )
+    return output.stdout.splitlines()
+
+
+def output_after(console: list[str], command: str) -> list[str]:
+    """Get the console lines printed after the last time a command was typed"""
+    for index in range(len(console) - 1, -1, -1):
+        if console[index].rstrip().endswith(command):
+            return console[index + 1:]
+    return []
@@ -1,7 +1,8 @@
-from mcstatus import BedrockServer
 from time import sleep
 from datetime import datetime
 from msm.config.load_config import Config
+from msm.services.bedrock_ping import BedrockPinger
+from typing import Callable, Optional
 import os
 import logging
 
@@ -9,10 +10,12 @@ import logging
 log = logging.getLogger("bsm")
 
 
-def check_playercount(cfg: Config) -> bool | str | None:
+def check_playercount(cfg: Config, on_check: Optional[Callable[[int], None]] = None) -> bool | str | None:
+    """Wait until no one has been online for the shutdown time, on_check is called with the player count of every check"""
 
     if cfg.mc_ip and cfg.timing_shutdown and cfg.mc_port is not None:
-        server = BedrockServer(str(cfg.mc_ip), int(cfg.mc_port))
+        # One socket is kept open for every check of the whole uptime
+        pinger = BedrockPinger()
         shutdown_sec = cfg.timing_shutdown * 60
         amount_of_checks = max(1, int(shutdown_sec / 10))
         interval_seconds = 10
@@ -27,37 +30,42 @@ def check_playercount(cfg: Config) -> bool | str | None:
     times_no_one = 0
     server_used = False
 
-    while True:
-        try:
-            status = server.status()  # type: ignore
-            online_players = status.players.online
-        except Exception as e:
-            log.error(f"Error checking server status: {e}")
+    with pinger:
+        while True:
+            try:
+                status = pinger.ping(str(cfg.mc_ip), int(cfg.mc_port))  # type: ignore
+                online_players = status.players
+                log.debug(f"{online_players}/{status.max_players} online, {status.latency:.0f} ms")
+            except Exception as e:
+                log.error(f"Error checking server status: {e}")
+                sleep(interval_seconds)
+                # Skip loop if player count is not found 
+                continue
+
+            if online_players == 0:
+                times_no_one += 1
+                log.info(f"No one online ({times_no_one}/{amount_of_checks})")
+            elif online_players > 0:
+                log.info(f"Someone online")
+                server_used = True
+                times_no_one = 0
+            else:
+                log.error(f"Unexpected value: {status.players}")
+                return None
+
+            if on_check:
+                on_check(online_players)
+
+            # If no one has been online for the set time, exit function
+            if times_no_one >= amount_of_checks:
+                # Check if no_shutdown flag is present, reset loop if it is
+                if cfg.path_base:
+                    if os.path.exists(os.path.join(cfg.path_base, "no_shutdown.flag")):
+                        times_no_one = 0
+                        log.info(f"No-shutdown flag found, restarting check...")
+                    else:
+                        # Return if a backup is needed
+                        return server_used
+
+            # Wait before next check
             sleep(interval_seconds)
-            # Skip loop if player count is not found 
-            continue
-
-        if online_players == 0:
-            times_no_one += 1
-            log.info(f"No one online ({times_no_one}/{amount_of_checks})")
-        elif online_players > 0:
-            log.info(f"Someone online")
-            server_used = True
-            times_no_one = 0
-        else:
-            log.error(f"Unexpected value: {status.players.online}")
-            return None
-
-        # If no one has been online for the set time, exit function
-        if times_no_one >= amount_of_checks:
-            # Check if no_shutdown flag is present, reset loop if it is
-            if cfg.path_base:
-                if os.path.exists(os.path.join(cfg.path_base, "no_shutdown.flag")):
-                    times_no_one = 0
-                    log.info(f"No-shutdown flag found, restarting check...")
-                else:
-                    # Return if a backup is needed
-                    return server_used
-
-        # Wait before next check
-        sleep(interval_seconds)